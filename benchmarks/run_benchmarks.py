@@ -0,0 +1,433 @@
+"""
+Benchmarks for the cost builders, the OT solvers and the Sinkhorn loss.
+
+Each benchmark is run for a grid of parameters (number of stations N, number of
+time steps T, batch size and dtype). Wall time (best and median of several
+repeats) and peak memory are stored as JSON, such that runs before and after an
+upgrade can be compared:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --output after.json
+    python benchmarks/run_benchmarks.py --compare before.json after.json
+
+The peak memory of the numpy benchmarks is measured on the Python heap with
+tracemalloc. Memory allocated by torch is not seen by tracemalloc, so the torch
+benchmarks are run once more in a subprocess, and their peak memory is the
+increase of the peak resident set size (ru_maxrss) during the first call.
+Allocations that stay below the peak of the setup (small problems) show as 0,
+and the memory is null where the resource module is not available (Windows).
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+import numpy as np
+import ot
+import scipy
+import torch
+from geot.cost import space_cost_matrix, spacetime_cost_matrix
+from geot.partialot import (
+    MultiscalePartialOT,
+    PartialOT,
+    RollingPartialOT,
+    partial_ot_unpaired,
+)
+from geot.sinkhorn_loss import SinkhornLoss
+
+DTYPES = {"float32": np.float32, "float64": np.float64}
+
+# parameter grids: full run and quick run (e.g. for CI)
+GRIDS = {
+    "full": {"n": [50, 200, 500], "time_steps": [1, 4], "batch": [1, 16]},
+    # the multiscale solver only pays off for many locations
+    "large": {"n": [1500, 3000], "time_steps": [1], "batch": [1, 4]},
+    "quick": {"n": [20, 50], "time_steps": [1, 2], "batch": [1, 4]},
+}
+
+
+def _coords(n, seed=0):
+    return np.random.default_rng(seed).random((n, 2)) * 10000
+
+
+def _masses(batch, n, dtype, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.random((batch, n)).astype(dtype), rng.random((batch, n)).astype(dtype)
+
+
+def bench_space_cost_matrix(n, time_steps, batch, dtype):
+    coords = _coords(n)
+    return lambda: space_cost_matrix(coords, speed_factor=10)
+
+
+def bench_spacetime_cost_matrix(n, time_steps, batch, dtype):
+    coords = _coords(n)
+    return lambda: spacetime_cost_matrix(
+        space_cost_matrix(coords, speed_factor=10), time_steps=time_steps
+    )
+
+
+def _cost_matrix(n, time_steps):
+    cost_matrix = space_cost_matrix(_coords(n), speed_factor=10)
+    if time_steps > 1:
+        cost_matrix = spacetime_cost_matrix(cost_matrix, time_steps=time_steps)
+    return cost_matrix
+
+
+def bench_partial_ot_exact(n, time_steps, batch, dtype):
+    ot_obj = PartialOT(_cost_matrix(n, time_steps), penalty_waste="max")
+    pred, gt = _masses(batch, n * time_steps, dtype)
+    return lambda: ot_obj(pred, gt)
+
+
+def _noisy_counts(batch, n, seed=1):
+    """Poisson counts around a common mean, i.e. a prediction with local errors"""
+    rng = np.random.default_rng(seed)
+    mean = rng.gamma(2, 2, n)
+    return rng.poisson(mean, (batch, n)).astype(float), rng.poisson(
+        mean, (batch, n)
+    ).astype(float)
+
+
+def bench_partial_ot_dense_noisy(n, time_steps, batch, dtype):
+    ot_obj = PartialOT(_cost_matrix(n, 1), penalty_waste="max")
+    pred, gt = _noisy_counts(batch, n)
+    return lambda: ot_obj(pred, gt)
+
+
+def bench_partial_ot_multiscale(n, time_steps, batch, dtype):
+    # the same problems as partial_ot_dense_noisy
+    ot_obj = MultiscalePartialOT(_cost_matrix(n, 1), penalty_waste="max")
+    pred, gt = _noisy_counts(batch, n)
+    return lambda: ot_obj(pred, gt)
+
+
+def bench_partial_ot_entropic(n, time_steps, batch, dtype):
+    ot_obj = PartialOT(
+        _cost_matrix(n, time_steps),
+        penalty_waste="max",
+        entropy_regularized=True,
+        dtype=getattr(torch, dtype.__name__),
+    )
+    pred, gt = _masses(batch, n * time_steps, dtype)
+    return lambda: ot_obj(pred, gt)
+
+
+def bench_partial_ot_unpaired(n, time_steps, batch, dtype):
+    coords_pred, coords_gt = _coords(n, seed=2), _coords(n, seed=3)
+    return lambda: partial_ot_unpaired(coords_pred, coords_gt, penalty_waste="max")
+
+
+def _rolling_series(batch, n, seed=1):
+    """Counts of consecutive time steps: the prediction of 10 stations changes
+    per step, the ground truth stays the same"""
+    rng = np.random.default_rng(seed)
+    mean = rng.gamma(2, 2, n)
+    pred = np.repeat(rng.poisson(mean)[np.newaxis].astype(float), batch, axis=0)
+    for step in range(1, batch):
+        changed = rng.integers(0, n, 10)
+        pred[step:, changed] = rng.poisson(mean[changed])
+    gt = np.repeat(rng.poisson(mean)[np.newaxis].astype(float), batch, axis=0)
+    return pred, gt
+
+
+def bench_rolling_partial_ot(n, time_steps, batch, dtype):
+    # the time series are the rows of the batch, the first solve is cold
+    ot_obj = RollingPartialOT(_cost_matrix(n, 1), penalty_waste="max")
+    pred, gt = _rolling_series(batch, n)
+
+    def solve_series():
+        ot_obj.reset()
+        ot_obj(pred, gt)
+
+    return solve_series
+
+
+def simplex_pivots(a, b, cost_matrix, potentials_init=None):
+    """Number of network simplex iterations of ot.emd. POT does not report it,
+    so it is found by bisection over numItermax (about 2 * log2(pivots) solves)"""
+
+    def converged(max_iter):
+        _, log = ot.emd(
+            a,
+            b,
+            cost_matrix,
+            numItermax=max_iter,
+            log=True,
+            potentials_init=potentials_init,
+        )
+        return log["result_code"] == 1
+
+    low, high = 0, 1
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        while not converged(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if converged(middle):
+                high = middle
+            else:
+                low = middle
+    return high
+
+
+def rolling_partial_ot_pivots(n, time_steps, batch, dtype):
+    """Mean network simplex iterations of the warm-started solves of
+    rolling_partial_ot, and of cold solves of the same problems"""
+    ot_obj = RollingPartialOT(_cost_matrix(n, 1), penalty_waste="max")
+    pred, gt = _rolling_series(batch, n)
+    extended_pred, extended_true = (array.copy() for array in ot_obj._extend(pred, gt))
+    cold, warm, potentials = [], [], None
+    for a, b in zip(extended_pred, extended_true):
+        cold.append(simplex_pivots(a, b, ot_obj.cost_matrix))
+        if potentials is not None:
+            warm.append(simplex_pivots(a, b, ot_obj.cost_matrix, potentials))
+        _, log = ot.emd(a, b, ot_obj.cost_matrix, log=True, potentials_init=potentials)
+        potentials = (log["u"], log["v"])
+    return {
+        "cold_pivots": float(np.mean(cold[1:])) if warm else None,
+        "warm_pivots": float(np.mean(warm)) if warm else None,
+    }
+
+
+def bench_sinkhorn_loss(n, time_steps, batch, dtype):
+    loss_fn = SinkhornLoss(
+        _cost_matrix(n, time_steps),
+        spatiotemporal=time_steps > 1,
+        dtype=getattr(torch, dtype.__name__),
+    )
+    shape = (batch, time_steps, n) if time_steps > 1 else (batch, n)
+    pred, gt = _masses(batch, n * time_steps, dtype)
+    pred = torch.tensor(pred.reshape(shape), requires_grad=True)
+    gt = torch.tensor(gt.reshape(shape))
+
+    def forward_backward():
+        loss = loss_fn(pred, gt)
+        loss.backward()
+        pred.grad = None
+
+    return forward_backward
+
+
+BENCHMARKS = {
+    "space_cost_matrix": bench_space_cost_matrix,
+    "spacetime_cost_matrix": bench_spacetime_cost_matrix,
+    "partial_ot_exact": bench_partial_ot_exact,
+    "partial_ot_dense_noisy": bench_partial_ot_dense_noisy,
+    "partial_ot_multiscale": bench_partial_ot_multiscale,
+    "partial_ot_entropic": bench_partial_ot_entropic,
+    "partial_ot_unpaired": bench_partial_ot_unpaired,
+    "rolling_partial_ot": bench_rolling_partial_ot,
+    "sinkhorn_loss": bench_sinkhorn_loss,
+}
+
+# benchmarks that allocate with torch, their memory is measured in a subprocess
+TORCH_BENCHMARKS = ["partial_ot_entropic", "sinkhorn_loss"]
+
+# solver iterations, stored with the results of a benchmark
+ITERATION_COUNTS = {"rolling_partial_ot": rolling_partial_ot_pivots}
+
+# parameters that do not affect a benchmark are not swept (exact OT always
+# solves in float64)
+IGNORED_PARAMS = {
+    "partial_ot_exact": ["dtype"],
+    "space_cost_matrix": ["time_steps", "batch", "dtype"],
+    "spacetime_cost_matrix": ["batch", "dtype"],
+    "partial_ot_unpaired": ["time_steps", "batch", "dtype"],
+    "partial_ot_dense_noisy": ["time_steps", "dtype"],
+    "partial_ot_multiscale": ["time_steps", "dtype"],
+    "rolling_partial_ot": ["time_steps", "dtype"],
+}
+
+
+def measure(function, repeat=3):
+    """Wall time of function (best and median over repeats, in s) and the peak
+    memory (in bytes) of one additional call"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "time_best": min(times),
+        "time_median": float(np.median(times)),
+        "peak_memory": peak_memory,
+    }
+
+
+def peak_rss_increase(name, params):
+    """Increase of the peak resident set size (in bytes) during the first call
+    of a benchmark, measured in a fresh subprocess"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--rss", name, json.dumps(params)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return int(process.stdout.strip().splitlines()[-1])
+
+
+def _rss_child(name, params):
+    """Run one call of a benchmark and print the increase of ru_maxrss"""
+    import resource
+
+    function = BENCHMARKS[name](
+        params["n"],
+        params["time_steps"],
+        params["batch"],
+        DTYPES[params["dtype"] or "float64"],
+    )
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    function()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    print((after - before) * unit)
+
+
+def environment():
+    """Versions and machine, stored with the results"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "pot": ot.__version__,
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run(names, grid, dtypes, repeat=3):
+    """Run the benchmarks for all combinations of the parameters in grid"""
+    results = []
+    for name in names:
+        ignored = IGNORED_PARAMS.get(name, [])
+        seen = set()
+        for n, time_steps, batch, dtype in itertools.product(
+            grid["n"], grid["time_steps"], grid["batch"], dtypes
+        ):
+            params = {"n": n, "time_steps": time_steps, "batch": batch, "dtype": dtype}
+            for param in ignored:
+                params[param] = None
+            key = tuple(params.values())
+            if key in seen:
+                continue
+            seen.add(key)
+            function = BENCHMARKS[name](
+                n, time_steps, batch, DTYPES[params["dtype"] or "float64"]
+            )
+            result = {"benchmark": name, "params": params, **measure(function, repeat)}
+            if name in TORCH_BENCHMARKS:
+                result["peak_memory"] = peak_rss_increase(name, params)
+            if name in ITERATION_COUNTS:
+                result.update(
+                    ITERATION_COUNTS[name](
+                        n, time_steps, batch, DTYPES[params["dtype"] or "float64"]
+                    )
+                )
+            memory = result["peak_memory"]
+            memory = "      n/a" if memory is None else f"{memory / 1024**2:9.1f}"
+            iterations = "".join(
+                f" {key}={value:.0f}"
+                for key, value in result.items()
+                if key.endswith("_pivots") and value is not None
+            )
+            print(
+                f"{name:24} {json.dumps(params):70} {result['time_best']:9.4f} s"
+                f" {memory} MB{iterations}"
+            )
+            results.append(result)
+    return results
+
+
+def compare(old_path, new_path, threshold=1.2):
+    """Print the ratio of the times and peak memory of two runs, and return the
+    benchmarks that got slower by more than threshold"""
+    with open(old_path, "r") as infile:
+        old = json.load(infile)["results"]
+    with open(new_path, "r") as infile:
+        new = json.load(infile)["results"]
+    key = lambda result: (result["benchmark"], json.dumps(result["params"]))
+    old = {key(result): result for result in old}
+    regressions = []
+    for result in new:
+        if key(result) not in old:
+            continue
+        time_ratio = result["time_best"] / old[key(result)]["time_best"]
+        if result["peak_memory"] is None or old[key(result)]["peak_memory"] is None:
+            memory = "  n/a"
+        else:
+            memory_ratio = result["peak_memory"] / max(
+                old[key(result)]["peak_memory"], 1
+            )
+            memory = f"{memory_ratio:5.2f}"
+        flag = "  <- slower" if time_ratio > threshold else ""
+        print(
+            f"{result['benchmark']:24} {json.dumps(result['params']):70}"
+            f" time x{time_ratio:5.2f} memory x{memory}{flag}"
+        )
+        if time_ratio > threshold:
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="benchmark_results.json", type=str)
+    parser.add_argument(
+        "-b", "--benchmarks", nargs="+", default=list(BENCHMARKS.keys())
+    )
+    parser.add_argument("--dtypes", nargs="+", default=["float64", "float32"])
+    parser.add_argument("--quick", action="store_true", help="small problems only")
+    parser.add_argument("--large", action="store_true", help="large problems only")
+    parser.add_argument("-r", "--repeat", default=3, type=int)
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two runs"
+    )
+    parser.add_argument("--threshold", default=1.2, type=float)
+    # internal: memory of one benchmark case, see peak_rss_increase
+    parser.add_argument("--rss", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.rss is not None:
+        _rss_child(args.rss[0], json.loads(args.rss[1]))
+    elif args.compare is not None:
+        regressions = compare(*args.compare, threshold=args.threshold)
+        print(f"{len(regressions)} benchmarks slower by more than x{args.threshold}")
+    else:
+        grid = GRIDS["quick" if args.quick else "large" if args.large else "full"]
+        results = run(args.benchmarks, grid, args.dtypes, args.repeat)
+        with open(args.output, "w") as outfile:
+            json.dump(
+                {"environment": environment(), "grid": grid, "results": results},
+                outfile,
+                indent=1,
+            )
@@ -0,0 +1,281 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+from geot.cost import blockwise_space_cost_matrix, SpaceTimeCostMatrix
+from geot.instrumentation import count
+
+# scale functions are referenced by name, such that they can be part of the key
+SCALE_FUNCTIONS = {
+    "square": np.square,
+    "sqrt": np.sqrt,
+    "log1p": np.log1p,
+}
+
+
+def register_scale_function(name, function):
+    """Register a scale function under a name for CostMatrixCache"""
+    SCALE_FUNCTIONS[name] = function
+
+
+class CostMatrixCache:
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        """
+        Disk cache for cost matrices. Matrices are stored as .npy files, keyed
+        by a fingerprint of the coordinates and parameters, and returned as
+        read-only memory maps, such that worker processes share the same pages
+        instead of holding one copy each.
+
+        Args:
+            cache_dir (str): directory for the .npy files
+            max_bytes (int): maximum size of the cache. The least recently used
+                matrices are deleted when the size is exceeded.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(coords1, coords2=None, **params):
+        """Hash of the coordinates and the parameters"""
+        key = hashlib.sha256()
+        for coords in [coords1, coords2]:
+            if coords is not None:
+                coords = np.ascontiguousarray(coords, dtype=np.float64)
+                key.update(str(coords.shape).encode())
+                key.update(coords.tobytes())
+            key.update(b"|")
+        key.update(json.dumps(params, sort_keys=True).encode())
+        return key.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def _get_or_create(self, key, shape, fill):
+        """Open the cached matrix, or create it with fill(out) into a new file"""
+        path = self._path(key)
+        if os.path.exists(path):
+            self.hits += 1
+            count("cost_matrix_cache.hits")
+            # mark as recently used
+            os.utime(path)
+            return np.load(path, mmap_mode="r")
+
+        self.misses += 1
+        count("cost_matrix_cache.misses")
+        # write to a temporary file and rename, such that concurrent workers
+        # never read a partially written matrix
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(file_descriptor)
+        try:
+            out = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=np.float64, shape=shape
+            )
+            fill(out)
+            out.flush()
+            del out
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=path)
+        return np.load(path, mmap_mode="r")
+
+    def _scale_function(self, name):
+        if name is None:
+            return None
+        if not isinstance(name, str) or name not in SCALE_FUNCTIONS:
+            raise ValueError(
+                f"scale_function must be the name of a registered function, one of "
+                f"{list(SCALE_FUNCTIONS.keys())} (see register_scale_function)"
+            )
+        return SCALE_FUNCTIONS[name]
+
+    def space_cost_matrix(
+        self, coords1, coords2=None, speed_factor=None, scale_function=None
+    ):
+        """
+        Cached version of geot.cost.space_cost_matrix
+
+        Args:
+            coords1, coords2, speed_factor: see space_cost_matrix
+            scale_function (str): name of a registered scale function
+        Returns:
+            np.memmap: read-only cost matrix
+        """
+        scale = self._scale_function(scale_function)
+        key = self.fingerprint(
+            coords1,
+            coords2,
+            kind="space",
+            speed_factor=speed_factor,
+            scale_function=scale_function,
+        )
+        shape = (len(coords1), len(coords1 if coords2 is None else coords2))
+
+        def fill(out):
+            # written block by block into the file, never held in memory
+            blockwise_space_cost_matrix(coords1, coords2, speed_factor, scale, out=out)
+
+        return self._get_or_create(key, shape, fill)
+
+    def spacetime_cost_matrix(
+        self,
+        coords,
+        speed_factor=None,
+        scale_function=None,
+        time_steps=3,
+        forward_cost=0,
+        backward_cost=1,
+    ):
+        """
+        Cached version of geot.cost.spacetime_cost_matrix for the spatial costs
+        space_cost_matrix(coords, speed_factor=..., scale_function=...)
+
+        Returns:
+            np.memmap: read-only space-time cost matrix
+        """
+        key = self.fingerprint(
+            coords,
+            kind="spacetime",
+            speed_factor=speed_factor,
+            scale_function=scale_function,
+            time_steps=time_steps,
+            forward_cost=forward_cost,
+            backward_cost=backward_cost,
+        )
+        shape = (time_steps * len(coords), time_steps * len(coords))
+
+        def fill(out):
+            time_matrix = self.space_cost_matrix(
+                coords, speed_factor=speed_factor, scale_function=scale_function
+            )
+            # written block by block into the file, never held in memory
+            SpaceTimeCostMatrix(
+                time_matrix, time_steps, forward_cost, backward_cost
+            ).toarray(out=out)
+
+        return self._get_or_create(key, shape, fill)
+
+    def evict(self, keep=None):
+        """Delete the least recently used matrices until the cache is small enough"""
+        paths = [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if name.endswith(".npy")
+        ]
+        paths = sorted(paths, key=os.path.getmtime)
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+        for path in paths:
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            total_bytes -= os.path.getsize(path)
+            # open memory maps stay valid after the file is deleted
+            os.remove(path)
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy"):
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+def array_fingerprint(array):
+    """
+    Fingerprint of an array: its shape, dtype and a hash of all its values,
+    such that in-place changes of any entry give a new fingerprint. Hashing
+    runs at about 1 GB/s, which is cheaper than preparing a new solver.
+    """
+    if not isinstance(array, np.ndarray):
+        # other cost representations (e.g. SparseCostMatrix) are identified
+        # by the object itself. SolverCache keeps a reference to it, such that
+        # the id is not reused while the entry exists.
+        return ("object", id(array))
+    return (
+        array.shape,
+        array.dtype.str,
+        hashlib.blake2b(np.ascontiguousarray(array).data, digest_size=16).hexdigest(),
+    )
+
+
+class SolverCache:
+    def __init__(self, maxsize=8):
+        """
+        Bounded LRU cache of prepared solvers (e.g. PartialOT or SinkhornLoss
+        objects), keyed by a fingerprint of the cost matrix and the constructor
+        parameters
+
+        Args:
+            maxsize (int): maximum number of cached solvers
+        """
+        self.maxsize = maxsize
+        self.solvers = collections.OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, factory, cost_matrix, **params):
+        """
+        Return the cached solver factory(cost_matrix, **params), or create it
+
+        Note: arrays are identified by their values, other cost objects (e.g.
+        SparseCostMatrix) by identity. Call clear() after modifying such an
+        object in place.
+        """
+        try:
+            key = (factory, array_fingerprint(cost_matrix), _hashable(params))
+            hash(key)
+        except TypeError:
+            # unhashable parameters: do not cache
+            self.misses += 1
+            return factory(cost_matrix, **params)
+
+        # the entries hold the cost object, such that its id cannot be reused
+        # by another object while the entry exists
+        if key in self.solvers and (
+            isinstance(cost_matrix, np.ndarray) or self.solvers[key][1] is cost_matrix
+        ):
+            self.hits += 1
+            count("solver_cache.hits")
+            self.solvers.move_to_end(key)
+            return self.solvers[key][0]
+        self.misses += 1
+        count("solver_cache.misses")
+        solver = factory(cost_matrix, **params)
+        self.solvers[key] = (solver, cost_matrix)
+        self.solvers.move_to_end(key)
+        if len(self.solvers) > self.maxsize:
+            _close(self.solvers.popitem(last=False)[1][0])
+        return solver
+
+    def cache_info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.solvers),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+        for solver, _ in self.solvers.values():
+            _close(solver)
+        self.solvers.clear()
+        self.hits, self.misses = 0, 0
+
+
+def _close(solver):
+    """Release the resources of a solver, e.g. the worker pool of PartialOT"""
+    close = getattr(solver, "close", None)
+    if close is not None:
+        close()
+
+
+def _hashable(params):
+    return tuple(
+        sorted(
+            (name, _hashable(value) if isinstance(value, dict) else value)
+            for name, value in params.items()
+        )
+    )
@@ -1,6 +1,11 @@
 import numpy as np
 import argparse
 import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from scipy.sparse import coo_array, csr_array, issparse
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
 
 
@@ -28,6 +33,645 @@ def space_cost_matrix(coords1, coords2=None, speed_factor=None, scale_function=N
     return time_matrix
 
 
+EARTH_RADIUS = 6371000  # in m
+
+
+def haversine_distances(coords1, coords2):
+    """
+    Great-circle distances (in m) between locations given as (lat, lon) in
+    degrees, of shape (N, 2) and (M, 2)
+    """
+    lat1, lon1 = np.radians(coords1[:, 0])[:, None], np.radians(coords1[:, 1])[:, None]
+    lat2, lon2 = np.radians(coords2[:, 0])[None], np.radians(coords2[:, 1])[None]
+    term = np.sin((lat2 - lat1) / 2) ** 2
+    term += np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    np.clip(term, 0, 1, out=term)
+    np.sqrt(term, out=term)
+    np.arcsin(term, out=term)
+    term *= 2 * EARTH_RADIUS
+    return term
+
+
+def blockwise_space_cost_matrix(
+    coords1,
+    coords2=None,
+    speed_factor=None,
+    scale_function=None,
+    metric="euclidean",
+    dtype=np.float64,
+    out=None,
+    block_size=1024,
+    n_workers=1,
+):
+    """
+    Memory-bounded version of space_cost_matrix for large sets of locations:
+    the matrix is computed in blocks of rows that are written into a
+    preallocated (e.g. memory-mapped) output, and speed_factor and
+    scale_function are applied per block. Memory grows with
+    n_workers * block_size * M besides the output.
+
+    Args:
+        coords1, coords2: coordinates of shape (N, 2) and (M, 2). If coords2 is
+            None, coords1 is used.
+        speed_factor: speed (in km/h) for converting distances to time
+        scale_function: function to scale the resulting costs, e.g.
+            lambda x: x**2
+        metric (str): "euclidean" for projected coordinates (in m), or
+            "haversine" for (lat, lon) in degrees
+        dtype: float type of the output, e.g. np.float32 to halve its size
+        out (np.ndarray or str, optional): array of shape (N, M) to write the
+            matrix into, or a path for a new .npy file that is memory-mapped
+            (see np.load(path, mmap_mode="r"))
+        block_size (int): number of rows computed at once
+        n_workers (int): number of threads computing blocks
+    Returns:
+        np.ndarray or np.memmap of shape (N, M)
+    """
+    assert metric in ["euclidean", "haversine"], "metric must be euclidean or haversine"
+    coords1 = np.asarray(coords1, dtype=float)
+    coords2 = coords1 if coords2 is None else np.asarray(coords2, dtype=float)
+    shape = (len(coords1), len(coords2))
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape)
+    assert out.shape == shape, f"out must have shape {shape}"
+
+    def fill_block(start):
+        end = min(start + block_size, shape[0])
+        if metric == "haversine":
+            block = haversine_distances(coords1[start:end], coords2)
+        else:
+            block = cdist(coords1[start:end], coords2)
+        # convert space to time (in h)
+        if speed_factor is not None:
+            block /= 1000 * speed_factor
+        if scale_function is not None:
+            block = scale_function(block)
+        out[start:end] = block
+
+    starts = range(0, shape[0], block_size)
+    if n_workers <= 1:
+        for start in starts:
+            fill_block(start)
+    else:
+        with ThreadPoolExecutor(n_workers) as pool:
+            # consume the results to raise exceptions of the workers
+            list(pool.map(fill_block, starts))
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+class SparseCostMatrix:
+    """
+    Cost matrix that only stores the costs between nearby locations (COO format).
+    All pairs that are not stored are assigned the cost fill_value.
+    """
+
+    def __init__(self, rows, cols, costs, shape, fill_value):
+        """
+        Args:
+            rows, cols: indices of the stored pairs, arrays of shape (nnz,)
+            costs: costs of the stored pairs, array of shape (nnz,)
+            shape: shape (N, M) of the full cost matrix
+            fill_value: cost of all pairs that are not stored
+        """
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.costs = np.asarray(costs, dtype=float)
+        self.shape = tuple(shape)
+        self.fill_value = float(fill_value)
+
+    @property
+    def nnz(self):
+        return len(self.costs)
+
+    def max(self):
+        if self.nnz == 0:
+            return self.fill_value
+        return max(np.max(self.costs), self.fill_value)
+
+    def scaled(self, factor):
+        """Return a copy with all costs multiplied by factor"""
+        return SparseCostMatrix(
+            self.rows,
+            self.cols,
+            self.costs * factor,
+            self.shape,
+            self.fill_value * factor,
+        )
+
+    def tocoo(self):
+        """Stored costs as scipy sparse array (explicit zeros are kept)"""
+        return coo_array((self.costs, (self.rows, self.cols)), shape=self.shape)
+
+    def toarray(self):
+        """Dense cost matrix where the pairs that are not stored are filled"""
+        dense = np.full(self.shape, self.fill_value)
+        dense[self.rows, self.cols] = self.costs
+        return dense
+
+
+def sparse_space_cost_matrix(
+    coords1,
+    coords2=None,
+    k=None,
+    max_cost=None,
+    speed_factor=None,
+    scale_function=None,
+    fill_value=None,
+):
+    """
+    Sparse version of space_cost_matrix, restricted to the k nearest neighbours
+    and / or the locations within a cost cutoff. Neighbours are found with a
+    KD-tree, so memory grows with N*k instead of N*M.
+
+    Args:
+        coords1, coords2: spatial coordinates (projected, distances in m) of
+            shape (N, 2) and (M, 2). If coords2 is None, coords1 is used.
+        k (int): number of nearest neighbours in coords2 for each location
+        max_cost (float): cutoff on the distance (in m), or on the travel time
+            (in h) if speed_factor is given
+        speed_factor: speed (in km/h) for converting distances to time
+        scale_function: function to scale the resulting costs, e.g.
+            lambda x: x**2
+        fill_value (float): cost of the pairs that are not stored. Defaults to
+            the (scaled) cutoff if max_cost is given, else the maximum stored cost
+    Returns:
+        SparseCostMatrix of shape (N, M)
+    """
+    if k is None and max_cost is None:
+        raise ValueError("Either k or max_cost is required, else use space_cost_matrix")
+    if coords2 is None:
+        coords2 = coords1
+    coords1, coords2 = np.asarray(coords1), np.asarray(coords2)
+    tree = cKDTree(coords2)
+
+    # convert time cutoff to distance cutoff (in m)
+    radius = max_cost
+    if max_cost is not None and speed_factor is not None:
+        radius = max_cost * speed_factor * 1000
+
+    if k is not None:
+        k = min(k, len(coords2))
+        dists, cols = tree.query(
+            coords1, k=k, distance_upper_bound=np.inf if radius is None else radius
+        )
+        dists, cols = dists.reshape(len(coords1), k), cols.reshape(len(coords1), k)
+        rows = np.repeat(np.arange(len(coords1)), k)
+        dists, cols = dists.ravel(), cols.ravel()
+        # neighbours beyond the cutoff are returned with infinite distance
+        found = np.isfinite(dists)
+        rows, cols, dists = rows[found], cols[found], dists[found]
+    else:
+        neighbors = tree.query_ball_point(coords1, r=radius)
+        rows = np.repeat(np.arange(len(coords1)), [len(n) for n in neighbors])
+        cols = np.concatenate(neighbors).astype(np.int64)
+        dists = np.linalg.norm(coords1[rows] - coords2[cols], axis=1)
+
+    # convert space to time (in h)
+    if speed_factor is not None:
+        costs = (dists / 1000) / speed_factor
+    else:
+        costs = dists
+
+    # apply scaling function (e.g. **p or applying cutoff)
+    if scale_function is not None:
+        costs = scale_function(costs)
+    if fill_value is None:
+        if max_cost is not None and scale_function is not None:
+            fill_value = scale_function(np.array([max_cost], dtype=float))[0]
+        elif max_cost is not None:
+            fill_value = max_cost
+        else:
+            fill_value = np.max(costs)
+    return SparseCostMatrix(rows, cols, costs, (len(coords1), len(coords2)), fill_value)
+
+
+# road graph of the shortest path search, set once per worker process
+_worker_graph = None
+
+
+def _init_graph_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _shortest_path_rows(
+    source_nodes, target_nodes, limit, directed, sources_per_search, graph=None
+):
+    """Shortest path lengths from the source nodes to the target nodes. dijkstra
+    returns the lengths to all nodes, so only sources_per_search sources are
+    searched at once and only the target columns are kept."""
+    if graph is None:
+        graph = _worker_graph
+    rows = np.empty((len(source_nodes), len(target_nodes)))
+    for start in range(0, len(source_nodes), sources_per_search):
+        end = start + sources_per_search
+        lengths = dijkstra(
+            graph, directed=directed, indices=source_nodes[start:end], limit=limit
+        )
+        rows[start:end] = lengths[:, target_nodes]
+    return rows
+
+
+def road_graph(edges, nr_nodes=None):
+    """
+    Sparse adjacency matrix of a road network
+
+    Args:
+        edges: array of shape (E, 3) with the start node, end node and length
+            (in m) of each road segment. Of parallel segments, the shortest is
+            kept.
+        nr_nodes (int, optional): number of nodes. Defaults to the largest node
+            index + 1.
+    Returns:
+        scipy.sparse.csr_array of shape (nr_nodes, nr_nodes)
+    """
+    edges = np.asarray(edges, dtype=float)
+    starts, ends = edges[:, 0].astype(int), edges[:, 1].astype(int)
+    if nr_nodes is None:
+        nr_nodes = max(starts.max(), ends.max()) + 1
+    # keep the shortest of parallel edges (csr would sum them)
+    order = np.lexsort((edges[:, 2], ends, starts))
+    starts, ends, lengths = starts[order], ends[order], edges[order, 2]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (starts[1:] != starts[:-1]) | (ends[1:] != ends[:-1])
+    return csr_array(
+        (lengths[first], (starts[first], ends[first])), shape=(nr_nodes, nr_nodes)
+    )
+
+
+def snap_to_nodes(coords, node_coords, max_distance=None):
+    """
+    Index of the closest node of the road network for each location
+
+    Args:
+        coords: coordinates of the locations (projected, in m) of shape (N, 2)
+        node_coords: coordinates of the nodes of shape (nr_nodes, 2)
+        max_distance (float, optional): raise a ValueError if a location is
+            further than max_distance from the network
+    """
+    distances, nodes = cKDTree(node_coords).query(coords)
+    if max_distance is not None and np.any(distances > max_distance):
+        raise ValueError(
+            f"{np.sum(distances > max_distance)} locations are further than "
+            f"{max_distance} from the road network"
+        )
+    return nodes
+
+
+def network_cost_matrix(
+    graph,
+    station_nodes,
+    target_nodes=None,
+    speed_factor=None,
+    scale_function=None,
+    cutoff=None,
+    fill_value=None,
+    directed=True,
+    n_workers=1,
+    chunk_size=256,
+    max_memory=2**28,
+):
+    """
+    Cost matrix of shortest path lengths (or travel times) on a road network,
+    e.g. as input for PartialOT or SpaceTimeCostMatrix
+
+    Args:
+        graph: road network as scipy sparse adjacency matrix with the segment
+            lengths (in m), or as edge list (see road_graph)
+        station_nodes: node of each location (see snap_to_nodes)
+        target_nodes (optional): nodes of the columns. Defaults to station_nodes.
+        speed_factor: speed (in km/h) for converting distances to time
+        scale_function: function to scale the resulting costs, e.g.
+            lambda x: x**2
+        cutoff (float, optional): bound on the search, as distance (in m) or
+            travel time (in h) if speed_factor is given. Locations that are
+            further apart get fill_value.
+        fill_value (float, optional): cost of pairs beyond the cutoff or
+            without connection. Defaults to the (scaled) cutoff if given, else
+            the maximum cost.
+        directed (bool): Whether the road segments are one-way (from the start
+            to the end node). Defaults to True.
+        n_workers (int): number of worker processes for the shortest path
+            searches. The graph is sent once to each worker.
+        chunk_size (int): number of locations that are sent to a worker at
+            once. Their rows of the result take chunk_size * M * 8 bytes.
+        max_memory (int): memory (in bytes) per worker for the lengths to all
+            nodes of the network, which dijkstra returns before the target
+            columns are selected. With 1M nodes, the default of 256 MB allows
+            32 searches at once. At least one search runs at a time
+            (nr_nodes * 8 bytes).
+    Returns:
+        np.ndarray of shape (N, M)
+    """
+    if not issparse(graph):
+        graph = road_graph(graph)
+    station_nodes = np.asarray(station_nodes)
+    target_nodes = station_nodes if target_nodes is None else np.asarray(target_nodes)
+    # convert time cutoff to distance cutoff (in m)
+    limit = np.inf if cutoff is None else cutoff
+    if cutoff is not None and speed_factor is not None:
+        limit = cutoff * speed_factor * 1000
+
+    sources_per_search = int(max(1, max_memory // (8 * graph.shape[0])))
+    chunks = [
+        station_nodes[start : start + chunk_size]
+        for start in range(0, len(station_nodes), chunk_size)
+    ]
+    if n_workers <= 1 or len(chunks) == 1:
+        rows = [
+            _shortest_path_rows(
+                chunk, target_nodes, limit, directed, sources_per_search, graph
+            )
+            for chunk in chunks
+        ]
+    else:
+        solve_chunk = partial(
+            _shortest_path_rows,
+            target_nodes=target_nodes,
+            limit=limit,
+            directed=directed,
+            sources_per_search=sources_per_search,
+        )
+        with ProcessPoolExecutor(
+            n_workers, initializer=_init_graph_worker, initargs=(graph,)
+        ) as pool:
+            rows = list(pool.map(solve_chunk, chunks))
+    cost_matrix = np.concatenate(rows)
+
+    # convert space to time (in h)
+    if speed_factor is not None:
+        cost_matrix = (cost_matrix / 1000) / speed_factor
+    unreached = ~np.isfinite(cost_matrix)
+    if scale_function is not None:
+        cost_matrix = scale_function(cost_matrix)
+    if fill_value is None:
+        if cutoff is not None and scale_function is not None:
+            fill_value = scale_function(np.array([cutoff], dtype=float))[0]
+        elif cutoff is not None:
+            fill_value = cutoff
+        else:
+            fill_value = np.max(cost_matrix[~unreached], initial=0)
+    cost_matrix[unreached] = fill_value
+    return cost_matrix
+
+
+class SpaceTimeCostMatrix:
+    """
+    Space-time cost matrix (see spacetime_cost_matrix) that is not materialised.
+    Only the N x N spatial matrix and the T x T waiting times are stored; the
+    cost of block (t_pred, t_gt) is max(time_matrix, waiting_time[t_pred, t_gt]).
+    """
+
+    def __init__(self, time_matrix, time_steps=3, forward_cost=0, backward_cost=1):
+        """
+        Args:
+            time_matrix: 2D array of shape (N, N) with the spatial costs
+            time_steps (int): number of time steps T
+            forward_cost: cost for using demand that was originally allocated for
+                the preceding timestep (usually low) - in hours
+            backward_cost: cost for using demand that was allocated for the next
+                timestep - in hours
+        """
+        assert (
+            time_matrix.shape[0] == time_matrix.shape[1]
+        ), "only quadratic matrix supported atm for space_time_cost"
+        self.time_matrix = time_matrix
+        self.time_steps = time_steps
+        self.nr_stations = len(time_matrix)
+        # waiting time from timeslot t_pred (rows) to timeslot t_gt (columns)
+        steps = np.arange(time_steps)
+        lag = steps[None, :] - steps[:, None]
+        self.waiting_time = np.where(lag >= 0, lag * forward_cost, -lag * backward_cost)
+
+    @property
+    def shape(self):
+        size = self.time_steps * self.nr_stations
+        return (size, size)
+
+    def max(self):
+        return max(np.max(self.time_matrix), np.max(self.waiting_time))
+
+    def block(self, t_pred, t_gt):
+        """Cost matrix (N x N) from timeslot t_pred to timeslot t_gt"""
+        return np.maximum(self.time_matrix, self.waiting_time[t_pred, t_gt])
+
+    def rows(self, indices):
+        """Rows of the dense cost matrix with the given indices"""
+        indices = np.asarray(indices)
+        time_matrix = np.asarray(self.time_matrix)
+        space_cost = np.tile(time_matrix[indices % self.nr_stations], self.time_steps)
+        wait_cost = np.repeat(
+            self.waiting_time[indices // self.nr_stations], self.nr_stations, axis=1
+        )
+        return np.maximum(space_cost, wait_cost)
+
+    def cols(self, indices):
+        """Columns of the dense cost matrix with the given indices"""
+        indices = np.asarray(indices)
+        time_matrix = np.asarray(self.time_matrix)
+        space_cost = np.tile(
+            time_matrix[:, indices % self.nr_stations], (self.time_steps, 1)
+        )
+        wait_cost = np.repeat(
+            self.waiting_time[:, indices // self.nr_stations], self.nr_stations, axis=0
+        )
+        return np.maximum(space_cost, wait_cost)
+
+    def toarray(self, out=None):
+        """
+        Export the dense (T*N x T*N) cost matrix
+        Args:
+            out (np.ndarray, optional): Array to write the matrix into. Can be
+                larger than the cost matrix, e.g. to leave space for the waste
+                vector, in which case the upper left part is filled.
+        """
+        nr_stations = self.nr_stations
+        if out is None:
+            out = np.zeros(self.shape)
+        for t_pred in range(self.time_steps):
+            for t_gt in range(self.time_steps):
+                start_x, end_x = (t_pred * nr_stations, (t_pred + 1) * nr_stations)
+                start_y, end_y = (t_gt * nr_stations, (t_gt + 1) * nr_stations)
+                np.maximum(
+                    self.time_matrix,
+                    self.waiting_time[t_pred, t_gt],
+                    out=out[start_x:end_x, start_y:end_y],
+                )
+        return out
+
+    def _product(self, x, transform, transpose):
+        x = np.asarray(x)
+        x_blocks = x.reshape((self.time_steps, self.nr_stations) + x.shape[1:])
+        out = np.zeros_like(x_blocks, dtype=float)
+        for t_pred in range(self.time_steps):
+            for t_gt in range(self.time_steps):
+                if transpose:
+                    out[t_gt] += (
+                        transform(self.block(t_pred, t_gt)).T @ x_blocks[t_pred]
+                    )
+                else:
+                    out[t_pred] += transform(self.block(t_pred, t_gt)) @ x_blocks[t_gt]
+        return out.reshape(x.shape)
+
+    def dot(self, x, transpose=False):
+        """Matrix-vector product C @ x (or C.T @ x), with x of shape (T*N,) or
+        (T*N, k), computed block by block"""
+        return self._product(x, lambda block: block, transpose)
+
+    def kernel_dot(self, x, eps, transpose=False):
+        """Product exp(-C / eps) @ x with the Gibbs kernel of the costs"""
+        return self._product(x, lambda block: np.exp(-block / eps), transpose)
+
+
+class IncrementalCostMatrix:
+    def __init__(
+        self,
+        coords,
+        ids=None,
+        speed_factor=None,
+        scale_function=None,
+        capacity=None,
+        cost_function=None,
+    ):
+        """
+        Cost matrix between locations that are added and removed over time
+        (e.g. stations of a bike sharing network). Each location keeps its
+        index: a removed location leaves a free slot (with zero costs) that is
+        reused by the next added location, such that predictions and
+        observations of the remaining locations keep their order. Only the
+        rows and columns of added locations are computed, and attached solvers
+        (see attach) only copy these rows and columns.
+
+        Args:
+            coords: spatial coordinates (projected, distances in m) of shape (N, 2)
+            ids (list, optional): identifiers of the locations. Defaults to
+                0, ..., N-1.
+            speed_factor, scale_function: see space_cost_matrix
+            capacity (int, optional): number of slots of the matrix, i.e. the
+                maximum number of locations without reallocating the matrix.
+                Defaults to N.
+            cost_function (callable, optional): function (coords1, coords2)
+                returning the cost matrix between two sets of locations.
+                Defaults to space_cost_matrix with speed_factor and
+                scale_function.
+        """
+        coords = np.asarray(coords, dtype=float)
+        if ids is None:
+            ids = range(len(coords))
+        if cost_function is None:
+
+            def cost_function(coords1, coords2):
+                return space_cost_matrix(coords1, coords2, speed_factor, scale_function)
+
+        self.cost_function = cost_function
+        capacity = len(coords) if capacity is None else capacity
+        assert capacity >= len(
+            coords
+        ), "capacity must be at least the number of locations"
+        self.coords = np.full((capacity, coords.shape[1]), np.nan)
+        self.matrix = np.zeros((capacity, capacity))
+        self.ids = [None] * capacity
+        self.index = {}
+        self.solvers = []
+        self.add(ids, coords)
+
+    @property
+    def capacity(self):
+        return len(self.ids)
+
+    def attach(self, solver):
+        """
+        Keep a prepared solver (PartialOT or SinkhornLoss created with this
+        matrix, or with a SpaceTimeCostMatrix of it) up to date. Its
+        update_costs method is called with the indices of changed locations.
+        """
+        self.solvers.append(solver)
+
+    def _grow(self, capacity):
+        if len(self.solvers) > 0:
+            raise ValueError(
+                "Capacity exceeded, the attached solvers would need a new matrix. "
+                "Create the matrix with a larger capacity."
+            )
+        old_capacity = self.capacity
+        matrix = np.zeros((capacity, capacity))
+        matrix[:old_capacity, :old_capacity] = self.matrix
+        coords = np.full((capacity, self.coords.shape[1]), np.nan)
+        coords[:old_capacity] = self.coords
+        self.matrix, self.coords = matrix, coords
+        self.ids = self.ids + [None] * (capacity - old_capacity)
+
+    def add(self, ids, coords):
+        """
+        Add locations, computing only their rows and columns of the matrix
+
+        Returns:
+            np.ndarray: indices of the new locations
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1, self.coords.shape[1])
+        assert len(ids) == len(coords), "one id per location required"
+        for location_id in ids:
+            if location_id in self.index:
+                raise ValueError(f"Location {location_id} already exists")
+        free = [i for i, location_id in enumerate(self.ids) if location_id is None]
+        if len(free) < len(ids):
+            self._grow(max(2 * self.capacity, self.capacity + len(ids) - len(free)))
+            free = [i for i, location_id in enumerate(self.ids) if location_id is None]
+        indices = np.array(free[: len(ids)], dtype=int)
+        for location_id, index in zip(ids, indices):
+            self.ids[index] = location_id
+            self.index[location_id] = index
+        self.coords[indices] = coords
+
+        active = np.array([location_id is not None for location_id in self.ids])
+        self.matrix[np.ix_(indices, active)] = self.cost_function(
+            coords, self.coords[active]
+        )
+        self.matrix[np.ix_(active, indices)] = self.cost_function(
+            self.coords[active], coords
+        )
+        self._notify(indices)
+        return indices
+
+    def remove(self, ids):
+        """
+        Remove locations. Their slots get zero costs (predictions and
+        observations should be zero there) and are reused by add.
+
+        Returns:
+            np.ndarray: indices of the removed locations
+        """
+        indices = self.indices(ids)
+        for location_id, index in zip(ids, indices):
+            del self.index[location_id]
+            self.ids[index] = None
+        self.coords[indices] = np.nan
+        self.matrix[indices, :] = 0
+        self.matrix[:, indices] = 0
+        self._notify(indices)
+        return indices
+
+    def _notify(self, indices):
+        for solver in self.solvers:
+            solver.update_costs(indices)
+
+    def indices(self, ids):
+        """Indices of the locations with the given ids"""
+        return np.array([self.index[location_id] for location_id in ids], dtype=int)
+
+    def vector(self, ids, values):
+        """Arrange values given for the location ids in the order of the matrix
+        (zero for free slots)"""
+        values = np.asarray(values)
+        vector = np.zeros(values.shape[:-1] + (self.capacity,), dtype=values.dtype)
+        vector[..., self.indices(ids)] = values
+        return vector
+
+
 def spacetime_cost_matrix(
     time_matrix,
     time_steps=3,
@@ -48,24 +692,115 @@ def spacetime_cost_matrix(
         Cell i,j is the cost from timeslot=i//nr_stations and station=i%nr_stations
             to timeslot=j//nr_stations and station=j%nr_stations.
     """
-    assert (
-        time_matrix.shape[0] == time_matrix.shape[1]
-    ), "only quadratic matrix supported atm for space_time_cost"
-    nr_stations = len(time_matrix)
-
-    final_cost_matrix = np.zeros((time_steps * nr_stations, time_steps * nr_stations))
-    for t_pred in range(time_steps):
-        for t_gt in range(time_steps):
-            start_x, end_x = (t_pred * nr_stations, (t_pred + 1) * nr_stations)
-            start_y, end_y = (t_gt * nr_stations, (t_gt + 1) * nr_stations)
-            if t_pred > t_gt:
-                waiting_time = (t_pred - t_gt) * backward_cost
-                final_cost_matrix[start_x:end_x, start_y:end_y] = np.maximum(
-                    time_matrix, waiting_time * np.ones(time_matrix.shape)
+    return SpaceTimeCostMatrix(
+        time_matrix,
+        time_steps=time_steps,
+        forward_cost=forward_cost,
+        backward_cost=backward_cost,
+    ).toarray()
+
+
+class TimeExpandedGraph:
+    """
+    Space-time costs as a graph over the T*N (timeslot, station) nodes, for
+    solving spatiotemporal OT as min-cost flow. Temporal arcs connect a station
+    to itself in the adjacent timeslots (at the forward / backward cost), and
+    spatial arcs connect neighbouring stations, optionally across timeslots:
+    an arc that bridges k timeslots costs max(travel time, waiting time of k
+    slots), such that travel and waiting overlap as in SpaceTimeCostMatrix.
+    """
+
+    def __init__(self, spacetime_cost: SpaceTimeCostMatrix, k=None):
+        """
+        Args:
+            spacetime_cost (SpaceTimeCostMatrix): spatial costs and waiting times
+            k (int, optional): number of nearest stations that are connected by
+                spatial arcs (in both directions). Defaults to None, i.e. all
+                pairs. The min-cost flow equals the OT error with the dense
+                space-time cost matrix if the spatial costs satisfy the
+                triangle inequality (e.g. distances or travel times) and the
+                optimal transport only moves mass between neighbours.
+        """
+        self.spacetime_cost = spacetime_cost
+        self.time_steps = spacetime_cost.time_steps
+        self.nr_stations = spacetime_cost.nr_stations
+        self.k = k
+
+    @property
+    def shape(self):
+        return self.spacetime_cost.shape
+
+    def max(self):
+        return self.spacetime_cost.max()
+
+    def _neighbor_pairs(self):
+        time_matrix = np.asarray(self.spacetime_cost.time_matrix)
+        if self.k is None or self.k >= self.nr_stations - 1:
+            rows, cols = np.nonzero(~np.eye(self.nr_stations, dtype=bool))
+        else:
+            # k nearest stations of each station (excluding itself)
+            costs = time_matrix + np.diag(np.full(self.nr_stations, np.inf))
+            nearest = np.argpartition(costs, self.k, axis=1)[:, : self.k]
+            rows = np.repeat(np.arange(self.nr_stations), self.k)
+            cols = nearest.ravel()
+            # symmetric: connect i and j if either is a neighbour of the other
+            pairs = np.unique(
+                np.concatenate(
+                    [rows * self.nr_stations + cols, cols * self.nr_stations + rows]
                 )
-            else:
-                waiting_time = (t_gt - t_pred) * forward_cost
-                final_cost_matrix[start_x:end_x, start_y:end_y] = np.maximum(
-                    time_matrix, waiting_time * np.ones(time_matrix.shape)
+            )
+            rows, cols = pairs // self.nr_stations, pairs % self.nr_stations
+        return rows, cols, time_matrix[rows, cols]
+
+    def arcs(self):
+        """
+        Arcs of the graph. Node t * N + i is station i in timeslot t (the order
+        of the rows of the space-time cost matrix).
+
+        Returns:
+            tuple: arrays (sources, targets, costs)
+        """
+        nr_stations, time_steps = self.nr_stations, self.time_steps
+        waiting_time = self.spacetime_cost.waiting_time
+        rows, cols, space_costs = self._neighbor_pairs()
+        all_sources, all_targets, all_costs = [], [], []
+
+        def add_arcs(from_nodes, to_nodes, lag, costs):
+            """Add the arcs for all timeslots t with t + lag in range"""
+            slots = np.arange(max(0, -lag), min(time_steps, time_steps - lag))
+            offsets = np.repeat(slots * nr_stations, len(from_nodes))
+            all_sources.append(np.tile(from_nodes, len(slots)) + offsets)
+            all_targets.append(
+                np.tile(to_nodes, len(slots)) + offsets + lag * nr_stations
+            )
+            all_costs.append(np.tile(costs, len(slots)))
+
+        stations = np.arange(nr_stations)
+        add_arcs(rows, cols, 0, space_costs)
+        for direction in [1, -1]:
+            if time_steps < 2:
+                break
+            # waiting one slot forward / backward
+            rate = waiting_time[0, 1] if direction == 1 else waiting_time[1, 0]
+            add_arcs(stations, stations, direction, np.full(nr_stations, rate))
+            if rate == 0:
+                # free waiting before or after travelling is as cheap
+                continue
+            # travelling while waiting: an arc over lag slots costs
+            # max(travel time, waiting time). It is only needed up to the
+            # first lag where waiting is at least as long as travelling.
+            for lag in range(1, time_steps):
+                useful = (lag - 1) * rate < space_costs
+                if not np.any(useful):
+                    break
+                add_arcs(
+                    rows[useful],
+                    cols[useful],
+                    direction * lag,
+                    np.maximum(space_costs[useful], lag * rate),
                 )
-    return final_cost_matrix
+        return (
+            np.concatenate(all_sources),
+            np.concatenate(all_targets),
+            np.concatenate(all_costs).astype(float),
+        )
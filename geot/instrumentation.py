@@ -0,0 +1,173 @@
+import collections
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# the active Instrumentation object, None if instrumentation is disabled
+_active = None
+
+
+class _NullStage:
+    """Stage timer used while instrumentation is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.tic = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.instrumentation.record("time", self.name, time.perf_counter() - self.tic)
+        return False
+
+
+class Instrumentation:
+    def __init__(self, sinks=()):
+        """
+        Collects the time spent in the stages of the solvers and counters
+        (e.g. batch sizes, solver iterations, allocated bytes, cache hits).
+        Every measurement is also passed to the sinks.
+
+        Args:
+            sinks (list): callables sink(kind, name, value), where kind is
+                "time" (value in s) or "count", e.g. logging_sink()
+        """
+        self.sinks = list(sinks)
+        self.times = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+        # stages may run in the worker threads of PartialOT
+        self._lock = threading.Lock()
+
+    def record(self, kind, name, value):
+        with self._lock:
+            if kind == "time":
+                self.times[name] += value
+                self.calls[name] += 1
+            else:
+                self.counters[name] += value
+        for sink in self.sinks:
+            sink(kind, name, value)
+
+    def report(self):
+        """Total time and number of calls per stage, and the counters"""
+        with self._lock:
+            return {
+                "stages": {
+                    name: {"time": self.times[name], "calls": self.calls[name]}
+                    for name in self.times
+                },
+                "counters": dict(self.counters),
+            }
+
+    def to_prometheus(self, path=None, prefix="geot"):
+        """
+        Metrics in the Prometheus text format, e.g. for the textfile collector
+        of the node exporter
+
+        Args:
+            path (str, optional): file to write the metrics to
+            prefix (str): prefix of the metric names
+        Returns:
+            str: the metrics
+        """
+        report = self.report()
+        lines = [
+            f"# TYPE {prefix}_stage_seconds_total counter",
+            *[
+                f'{prefix}_stage_seconds_total{{stage="{name}"}} {stage["time"]}'
+                for name, stage in report["stages"].items()
+            ],
+            f"# TYPE {prefix}_stage_calls_total counter",
+            *[
+                f'{prefix}_stage_calls_total{{stage="{name}"}} {stage["calls"]}'
+                for name, stage in report["stages"].items()
+            ],
+            f"# TYPE {prefix}_events_total counter",
+            *[
+                f'{prefix}_events_total{{name="{name}"}} {value}'
+                for name, value in report["counters"].items()
+            ],
+        ]
+        text = "\n".join(lines) + "\n"
+        if path is not None:
+            with open(path, "w") as outfile:
+                outfile.write(text)
+        return text
+
+
+def logging_sink(logger=None, level=logging.DEBUG):
+    """Sink that logs every measurement, by default to the logger "geot" """
+    logger = logging.getLogger("geot") if logger is None else logger
+
+    def sink(kind, name, value):
+        if kind == "time":
+            logger.log(level, "%s took %.6f s", name, value)
+        else:
+            logger.log(level, "%s: %s", name, value)
+
+    return sink
+
+
+def enable(*sinks):
+    """
+    Start collecting measurements (replaces the active Instrumentation)
+
+    Returns:
+        Instrumentation: object with the measurements, see report()
+    """
+    global _active
+    _active = Instrumentation(sinks)
+    return _active
+
+
+def disable():
+    """Stop collecting measurements and return the last Instrumentation"""
+    global _active
+    instrumentation, _active = _active, None
+    return instrumentation
+
+
+@contextmanager
+def instrument(*sinks):
+    """
+    Collect measurements within a with-block, e.g.
+
+        with instrument(logging_sink()) as instrumentation:
+            ot_obj(y_pred, y_true)
+        print(instrumentation.report())
+    """
+    global _active
+    previous = _active
+    instrumentation = enable(*sinks)
+    try:
+        yield instrumentation
+    finally:
+        _active = previous
+
+
+def stage(name):
+    """Context manager that measures the time of a stage if enabled"""
+    if _active is None:
+        return _NULL_STAGE
+    return _Stage(_active, name)
+
+
+def count(name, value=1):
+    """Increase a counter if instrumentation is enabled"""
+    if _active is not None:
+        _active.record("count", name, value)
@@ -0,0 +1,66 @@
+import numpy as np
+from scipy.sparse import coo_array
+
+MAGIC = b"GEOTPLAN"
+
+
+class PlanWriter:
+    def __init__(self, path, shape, dtype=np.float64):
+        """
+        Append sparse OT matrices (one per timestep) to a compact binary file.
+        Each matrix is stored as its number of nonzeros followed by the row and
+        column indices (int32) and the transported mass (dtype).
+
+        Args:
+            path (str): output file, overwritten if it exists
+            shape (tuple): shape of all OT matrices, e.g. (N+1, N+1)
+            dtype: float type for the transported mass (np.float32 halves the
+                size of the file)
+        """
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        np.array([shape[0], shape[1], self.dtype.itemsize], dtype=np.int64).tofile(
+            self.file
+        )
+
+    def write(self, plan):
+        """Append one OT matrix (dense array or scipy sparse array)"""
+        plan = coo_array(plan)
+        assert plan.shape == tuple(self.shape), "all plans need the same shape"
+        nonzero = plan.data != 0
+        np.array([np.sum(nonzero)], dtype=np.int64).tofile(self.file)
+        plan.row[nonzero].astype(np.int32).tofile(self.file)
+        plan.col[nonzero].astype(np.int32).tofile(self.file)
+        plan.data[nonzero].astype(self.dtype).tofile(self.file)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_plans(path):
+    """
+    Read the OT matrices written with PlanWriter one after the other
+
+    Yields:
+        scipy.sparse.coo_array: one OT matrix per timestep
+    """
+    with open(path, "rb") as infile:
+        assert infile.read(len(MAGIC)) == MAGIC, "not a file written by PlanWriter"
+        n_rows, n_cols, itemsize = np.fromfile(infile, dtype=np.int64, count=3)
+        dtype = np.float32 if itemsize == 4 else np.float64
+        while True:
+            nnz = np.fromfile(infile, dtype=np.int64, count=1)
+            if len(nnz) == 0:
+                break
+            rows = np.fromfile(infile, dtype=np.int32, count=nnz[0])
+            cols = np.fromfile(infile, dtype=np.int32, count=nnz[0])
+            values = np.fromfile(infile, dtype=dtype, count=nnz[0])
+            yield coo_array((values, (rows, cols)), shape=(n_rows, n_cols))
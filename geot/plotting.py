@@ -1,6 +1,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
+from scipy.sparse import issparse
 
 plt.rcParams.update({"font.size": 13})
 
@@ -69,7 +70,7 @@ def plot_paired_transport_matrix(locations, predictions, observations, ot_matrix
         observations (np.array): array of shape (N), the observations
         transport_matrix (np.array): 2D array of shape (N+1, N+1), the optimal
             transport matrix between the predicted and true spatial distribution
-            (+1 for the waste vector)
+            (+1 for the waste vector). Can be a scipy sparse array.
     """
     head_width = 0.02 * np.mean(
         np.linalg.norm(
@@ -78,7 +79,18 @@ def plot_paired_transport_matrix(locations, predictions, observations, ot_matrix
         )
     )
     # get lists of indices for start and end stations
-    start_station_id, end_station_id = np.where(ot_matrix[:-1, :-1] > 0)
+    if issparse(ot_matrix):
+        ot_matrix = ot_matrix.tocoo()
+        nr_stations = ot_matrix.shape[0] - 1
+        transported = (
+            (ot_matrix.data > 0)
+            & (ot_matrix.row < nr_stations)
+            & (ot_matrix.col < nr_stations)
+        )
+        start_station_id = ot_matrix.row[transported]
+        end_station_id = ot_matrix.col[transported]
+    else:
+        start_station_id, end_station_id = np.where(ot_matrix[:-1, :-1] > 0)
     start_coords, end_coords = (
         locations[start_station_id],
         locations[end_station_id],
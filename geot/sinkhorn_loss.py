@@ -1,11 +1,38 @@
+import collections
 import geomloss
 import torch
 import numpy as np
 from torch.nn import MSELoss
+from geot.cache import SolverCache
+from geot.cost import SpaceTimeCostMatrix
+from geot.instrumentation import count, stage
+from geot.sinkhorn_solver import (
+    CoordinateCost,
+    CostOperator,
+    DenseCost,
+    SpaceTimeCost,
+    sinkhorn_divergence,
+)
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 NONZERO_FACTOR = 1e-5
 
+# prepared loss objects of sinkhorn_loss_from_numpy
+solver_cache = SolverCache(maxsize=8)
+
+
+def as_tensor(array, dtype=None, device=None):
+    """
+    Convert an array to a torch tensor without copying where possible: numpy
+    arrays and tensors that already have the requested dtype and device share
+    their memory with the result.
+    """
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+    if isinstance(array, np.ndarray):
+        array = torch.from_numpy(np.ascontiguousarray(array))
+    return torch.as_tensor(array, dtype=dtype, device=device)
+
 
 class SinkhornLoss:
     def __init__(
@@ -17,13 +44,23 @@ class SinkhornLoss:
         reach=0.01,
         scaling=0.1,
         mode="unbalanced",
+        dtype=None,
+        warm_start=False,
+        backend="geomloss",
+        max_memory=None,
+        max_potentials=10000,
         **sinkhorn_kwargs,
     ):
         """Initialize Sinkhorn loss to train NN with OT loss
 
         Args:
-            cost_matrix (np.ndarray): 2-dim numpy array with pairwise costs
-                between locations
+            cost_matrix (np.ndarray or CostOperator): 2-dim numpy array with
+                pairwise costs between locations, or a CostOperator that
+                computes the costs block-wise (see from_coordinates). A
+                SpaceTimeCostMatrix is used block-wise without materialising it.
+                With backend="native", a 3-dim array of shape
+                (batch_size, N, M) gives each batch element its own costs (used
+                for all time steps of 3-dim inputs).
             normalize_cost (bool): Whether to normalize cost matrix by dividing
                 by the maximum cost.
             spatiotemporal (bool): Set to True to compute the error for spatio-
@@ -41,35 +78,89 @@ class SinkhornLoss:
                 if mode=balancedSoftmax: pred is softmaxed, gt is normalized
                 if mode=balanced: pred and gt are both normalized to sum 1
                 Defaults to "unbalanced".
+            dtype (str or torch.dtype, optional): float type of the computation,
+                e.g. "float32" to halve the memory of large batches. The cost
+                matrix is converted once, inputs are converted on each call
+                (no copy if they already have this type). Defaults to None,
+                i.e. the cost matrix and the inputs keep their types.
+            warm_start (bool): Whether to keep the dual potentials of each sample
+                and start the next solve for the same sample from them, skipping
+                the eps-scaling (see warm_iterations of sinkhorn_divergence).
+                Samples are identified by the sample_ids passed to __call__, or
+                by their index in the batch. Requires the native backend, which
+                is then used automatically. Defaults to False.
+            backend (str): "geomloss" or "native". The native backend is our
+                batched log-domain solver (geot.sinkhorn_solver), which supports
+                warm starts, a cost matrix per batch element and early stopping
+                (pass tol and max_iter as sinkhorn_kwargs). The number of
+                iterations of the last call is stored in self.iterations.
+                CostOperators always use the native backend.
+            max_memory (int, optional): memory budget (in bytes) for the kernel
+                matrices. The OT problems of a batch (batch_size * steps_ahead
+                problems for 3-dim inputs) are then solved in chunks that fit
+                into the budget, and their losses are summed. Defaults to None,
+                i.e. all problems are solved at once.
+            max_potentials (int): maximum number of samples whose potentials
+                are kept for warm_start (4 vectors of length N or M each). The
+                least recently solved samples are dropped first, such that they
+                are solved cold again. Call reset_potentials() to free all of
+                them, e.g. after an epoch. Defaults to 10000.
         """
         assert mode in ["unbalanced", "balancedSoftmax", "balanced"]
+        assert backend in ["geomloss", "native"], "backend must be geomloss or native"
         self.mode = mode
         self.spatiotemporal = spatiotemporal
-        # adapt cost matrix type and size
-        if isinstance(cost_matrix, np.ndarray):
-            cost_matrix = torch.from_numpy(cost_matrix)
+        self.cost_operator = None
+        self.dtype = getattr(torch, dtype) if isinstance(dtype, str) else dtype
+        self.warm_start = warm_start
+        self.max_potentials = max_potentials
+        self.potentials = collections.OrderedDict()
+        self.iterations = None
+        self.max_memory = max_memory
+        # for update_costs
+        self.source_cost = cost_matrix
+        self.cost_scale = 1.0
+        if isinstance(cost_matrix, SpaceTimeCostMatrix):
+            cost_matrix = SpaceTimeCost(cost_matrix)
+        if warm_start:
+            # geomloss cannot start from given potentials
+            backend = "native"
+        if backend == "native" and not isinstance(cost_matrix, CostOperator):
+            cost_matrix = DenseCost(as_tensor(cost_matrix))
+        if isinstance(cost_matrix, CostOperator):
+            # lazy costs: use our own block-wise solver instead of geomloss
+            self.cost_operator = cost_matrix.to(device=device, dtype=self.dtype)
+            if normalize_cost:
+                self.cost_operator.scale = self.cost_operator.scale / cost_matrix.max()
+            self.solver_kwargs = dict(
+                blur=blur, reach=reach, scaling=scaling, **sinkhorn_kwargs
+            )
+            return
+        # adapt cost matrix type and size (converted and moved in one step)
+        cost_matrix = as_tensor(cost_matrix, dtype=self.dtype, device=device)
         # normalize to values betwen 0 and 1
         if normalize_cost:
-            cost_matrix = cost_matrix / torch.max(cost_matrix)
+            self.cost_scale = 1 / torch.max(cost_matrix).item()
+            cost_matrix = cost_matrix * self.cost_scale
         if cost_matrix.dim() != 3:
             if cost_matrix.dim() != 2:
                 raise ValueError("cost matrix cost_matrix must have 2 or 3 dimensions")
             cost_matrix = cost_matrix.unsqueeze(0)
 
         # cost matrics and locs both need a static representation and are
-        # modified later to match the batch size
-        self.cost_matrix = cost_matrix.to(device)
-        self.cost_matrix_original = self.cost_matrix.clone()
+        # broadcasted later to match the batch size
+        self.cost_matrix_original = cost_matrix
+        self.cost_matrix = self.cost_matrix_original
 
         # introduce dummy weights since we assume fixed locations
-        self.dummy_weights_alpha = torch.tensor(
-            [[[i] for i in range(cost_matrix.size()[-2])]]
-        ).float()
-        self.dummy_weights_beta = torch.tensor(
-            [[[i] for i in range(cost_matrix.size()[-1])]]
-        ).float()
-        self.dummy_weights_a = self.dummy_weights_alpha.clone()
-        self.dummy_weights_b = self.dummy_weights_beta.clone()
+        self.dummy_weights_alpha = (
+            torch.arange(cost_matrix.size()[-2]).float().view(1, -1, 1)
+        )
+        self.dummy_weights_beta = (
+            torch.arange(cost_matrix.size()[-1]).float().view(1, -1, 1)
+        )
+        self.dummy_weights_a = self.dummy_weights_alpha
+        self.dummy_weights_b = self.dummy_weights_beta
 
         # sinkhorn loss
         self.loss_object = geomloss.SamplesLoss(
@@ -83,17 +174,134 @@ class SinkhornLoss:
             **sinkhorn_kwargs,
         )
 
+    @classmethod
+    def from_coordinates(
+        cls, coords, speed_factor=None, power=1, block_size=1024, **kwargs
+    ):
+        """Initialize Sinkhorn loss with costs that are computed on the fly from
+        the coordinates of the locations, without storing the cost matrix
+
+        Args:
+            coords (np.ndarray): spatial coordinates (projected, distances in m)
+                of shape (N, 2)
+            speed_factor: speed (in km/h) for converting distances to time
+            power (float): exponent applied to the distance or time
+            block_size (int): number of rows of the cost matrix that are
+                computed at once. Memory grows with batch_size * block_size * N.
+            kwargs: other arguments of SinkhornLoss
+        """
+        cost = CoordinateCost(
+            coords, speed_factor=speed_factor, power=power, block_size=block_size
+        )
+        return cls(cost, **kwargs)
+
     def get_cost(self, a, b):
         return self.cost_matrix
 
     def adapt_to_batchsize(self, batch_size):
+        # expand only creates a view on the original cost matrix, so changing
+        # the batch size does not copy it (the small dummy weights are copied
+        # since geomloss requires them to be contiguous)
         if self.cost_matrix.size()[0] != batch_size:
-            self.cost_matrix = self.cost_matrix_original.repeat((batch_size, 1, 1))
+            self.cost_matrix = self.cost_matrix_original.expand(batch_size, -1, -1)
             self.dummy_weights_a = self.dummy_weights_alpha.repeat((batch_size, 1, 1))
             self.dummy_weights_b = self.dummy_weights_beta.repeat((batch_size, 1, 1))
 
-    def __call__(self, a_in, b_in):
-        """a_in: predictions, b_in: targets"""
+    def update_costs(self, indices):
+        """
+        Copy changed rows and columns of the cost matrix that was given on
+        initialization (e.g. the matrix of an IncrementalCostMatrix) to the
+        device, without copying the full matrix. The normalization is kept.
+
+        Args:
+            indices: indices of the changed locations (of the stations for a
+                SpaceTimeCostMatrix)
+        """
+        source = self.source_cost
+        if isinstance(self.cost_operator, SpaceTimeCost):
+            target, source = self.cost_operator.time_matrix, source.time_matrix
+        elif isinstance(self.cost_operator, DenseCost):
+            # the operator applies the normalization
+            target = self.cost_operator.cost_matrix
+        elif self.cost_operator is None and self.cost_matrix_original.size()[0] == 1:
+            target = self.cost_matrix_original[0]
+        else:
+            raise ValueError("Only 2-dim and space-time cost matrices can be updated")
+        scale = self.cost_scale if self.cost_operator is None else 1.0
+        indices = np.asarray(indices)
+        rows = as_tensor(source[indices], dtype=target.dtype, device=target.device)
+        cols = as_tensor(source[:, indices], dtype=target.dtype, device=target.device)
+        index = torch.as_tensor(indices, device=target.device)
+        target[index, :] = rows * scale
+        target[:, index] = cols * scale
+
+    def reset_potentials(self):
+        """Forget the dual potentials of all samples (for warm_start)"""
+        self.potentials = collections.OrderedDict()
+
+    def native_divergence(self, a, b, problem_ids, cost_operator=None):
+        """Sinkhorn divergence computed with the native solver. With warm_start,
+        the solve is initialised with the stored potentials if all problems of
+        the batch were solved before. cost_operator defaults to the costs
+        given on initialization."""
+        if cost_operator is None:
+            cost_operator = self.cost_operator
+        init = None
+        if self.warm_start:
+            previous = [self.potentials.get(problem_id) for problem_id in problem_ids]
+            if all(potentials is not None for potentials in previous):
+                init = tuple(
+                    (
+                        None
+                        if previous[0][k] is None
+                        else torch.stack([p[k] for p in previous])
+                    )
+                    for k in range(4)
+                )
+        loss, log = sinkhorn_divergence(
+            a, b, cost_operator, potentials=init, log=True, **self.solver_kwargs
+        )
+        self.iterations = log["iterations"]
+        count("sinkhorn.iterations", log["iterations"])
+        if self.warm_start:
+            for row, problem_id in enumerate(problem_ids):
+                self.potentials[problem_id] = tuple(
+                    None if potential is None else potential[row]
+                    for potential in log["potentials"]
+                )
+                self.potentials.move_to_end(problem_id)
+            while len(self.potentials) > self.max_potentials:
+                self.potentials.popitem(last=False)
+        return loss
+
+    def chunk_size(self, nr_problems, n, m, itemsize):
+        """Number of OT problems that are solved at once within max_memory"""
+        if self.max_memory is None:
+            return nr_problems
+        if self.cost_operator is not None:
+            # the native solver only holds one block of rows at a time
+            n = min(n, self.cost_operator.block_size)
+        else:
+            itemsize = max(itemsize, self.cost_matrix_original.element_size())
+        # the softmin holds about four temporaries of shape (chunk_size, n, m)
+        bytes_per_problem = 4 * n * m * itemsize
+        return int(max(1, min(nr_problems, self.max_memory // bytes_per_problem)))
+
+    def solve(self, a, b, problem_ids, cost_operator=None):
+        """Summed Sinkhorn loss of the OT problems in the rows of a and b"""
+        if self.cost_operator is not None:
+            return torch.sum(self.native_divergence(a, b, problem_ids, cost_operator))
+        # adapt cost matrix size to the batch size
+        self.adapt_to_batchsize(a.size()[0])
+        loss = self.loss_object(a, self.dummy_weights_a, b, self.dummy_weights_b)
+        return torch.sum(loss)
+
+    def __call__(self, a_in, b_in, sample_ids=None):
+        """a_in: predictions, b_in: targets, sample_ids (optional): identifiers
+        of the samples of the batch, used to look up their potentials for
+        warm_start (defaults to the index in the batch)"""
+        if self.dtype is not None:
+            a_in, b_in = a_in.to(self.dtype), b_in.to(self.dtype)
 
         # 1) Normalize dependent on the OT mode (balanced / unbalanced)
         b_in = b_in + NONZERO_FACTOR  # to prevent that all gt are zero
@@ -112,24 +320,78 @@ class SinkhornLoss:
         # 2) flatten one axis -> either for spatiotemporal OT or treating the
         # temporal axis as batch
         batch_size = a.size()[0]
-        if a.dim() == 3:
+        # batch element of each OT problem, to select per-batch costs
+        problem_rows = torch.arange(batch_size)
+        if sample_ids is None:
+            sample_ids = range(batch_size)
+        problem_ids = [
+            sample_id.item() if torch.is_tensor(sample_id) else sample_id
+            for sample_id in sample_ids
+        ]
+        if a.dim() == 3 and self.spatiotemporal:
+            # flatten the space-time axes
+            a = a.reshape((batch_size, -1))
+            b = b.reshape((batch_size, -1))
+        elif a.dim() == 3:
             # if we have to flatten at all, flatten time over the batch size
             steps_ahead = a.size()[1]
             a = a.reshape((batch_size * steps_ahead, -1))
             b = b.reshape((batch_size * steps_ahead, -1))
             batch_size = batch_size * steps_ahead
+            problem_rows = problem_rows.repeat_interleave(steps_ahead)
+            problem_ids = [
+                (sample_id, step)
+                for sample_id in problem_ids
+                for step in range(steps_ahead)
+            ]
 
-        # 3) Adapt cost matrix size to the batch size
-        self.adapt_to_batchsize(batch_size)
-
-        # 4) Normalize again if spatiotemporal (over the space-time axis)
+        # 3) Normalize again if spatiotemporal (over the space-time axis)
         # such that it overall sums up to 1
         if self.spatiotemporal and self.mode != "unbalanced":
             a = a / torch.unsqueeze(torch.sum(a, dim=-1), -1)
             b = b / torch.unsqueeze(torch.sum(b, dim=-1), -1)
 
-        loss = self.loss_object(a, self.dummy_weights_a, b, self.dummy_weights_b)
-        return torch.sum(loss)
+        # 4) Solve the OT problems in chunks that fit into the memory budget.
+        # Both solvers detach the dual potentials before the last step, so the
+        # autograd graph of a chunk holds no kernel matrices.
+        chunk_size = self.chunk_size(
+            batch_size, a.size()[-1], b.size()[-1], a.element_size()
+        )
+        per_batch_costs = (
+            isinstance(self.cost_operator, DenseCost)
+            and self.cost_operator.cost_matrix.dim() == 3
+        )
+        if per_batch_costs and len(self.cost_operator.cost_matrix) != len(a_in):
+            raise ValueError(
+                "The cost matrix has costs for "
+                f"{len(self.cost_operator.cost_matrix)} batch elements, but the "
+                f"batch size is {len(a_in)}"
+            )
+        if (
+            self.cost_operator is None
+            and len(self.cost_matrix_original) > 1
+            and (chunk_size < batch_size or batch_size != len(a_in))
+        ):
+            raise ValueError(
+                "Costs per batch element require backend='native' with "
+                "max_memory or 3-dim inputs"
+            )
+        count("sinkhorn.batch_size", batch_size)
+        loss = 0
+        for start in range(0, batch_size, chunk_size):
+            end = start + chunk_size
+            # the costs of the batch elements of the chunk
+            cost_operator = (
+                self.cost_operator.select(problem_rows[start:end])
+                if per_batch_costs
+                else None
+            )
+            count("sinkhorn.chunks")
+            with stage("sinkhorn.solve"):
+                loss = loss + self.solve(
+                    a[start:end], b[start:end], problem_ids[start:end], cost_operator
+                )
+        return loss
 
 
 class CombinedLoss:
@@ -166,13 +428,20 @@ def sinkhorn_loss_from_numpy(
     mode="unbalanced",
     sinkhorn_kwargs={},
     loss_class=SinkhornLoss,
+    use_cache=True,
+    dtype=torch.float32,
 ):
-    a = torch.tensor(a.tolist()).float()
-    b = torch.tensor(b.tolist()).float()
+    # float32 arrays are used without copying
+    a = as_tensor(a, dtype=dtype)
+    b = as_tensor(b, dtype=dtype)
     # cost_matrix = torch.tensor([cost_matrix])
     # # Testing for the case where multiple steps ahead are predicted
     # a = a.unsqueeze(1).repeat(1, 3, 1)
     # b = b.unsqueeze(1).repeat(1, 3, 1)
     # print("Before initializing", cost_matrix.shape, a.size(), b.size())
-    loss = loss_class(cost_matrix, mode=mode, **sinkhorn_kwargs)
+    if use_cache:
+        # reuse the loss object (cost matrix on the device, geomloss object)
+        loss = solver_cache.get(loss_class, cost_matrix, mode=mode, **sinkhorn_kwargs)
+    else:
+        loss = loss_class(cost_matrix, mode=mode, **sinkhorn_kwargs)
     return loss(a, b)
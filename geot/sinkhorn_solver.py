@@ -0,0 +1,352 @@
+import numpy as np
+import torch
+
+
+class CostOperator:
+    """
+    Cost matrix between fixed locations that is never materialised. Costs are
+    computed on the fly in blocks of rows (block_size rows at a time).
+    """
+
+    block_size = 1024
+    scale = 1.0
+
+    @property
+    def shape(self):
+        raise NotImplementedError
+
+    def to(self, device=None, dtype=None):
+        """Move the data of the operator to a device and / or float type"""
+        return self
+
+    def cost_block(self, start, end, transpose=False):
+        """Return the costs of rows start:end (of the transposed matrix if
+        transpose=True), with shape (end - start, M)"""
+        raise NotImplementedError
+
+    def max(self):
+        """Maximum cost, computed block by block"""
+        max_cost = -np.inf
+        for start in range(0, self.shape[0], self.block_size):
+            end = min(start + self.block_size, self.shape[0])
+            max_cost = max(max_cost, torch.max(self.cost_block(start, end)).item())
+        return max_cost
+
+
+class DenseCost(CostOperator):
+    def __init__(self, cost_matrix, block_size=1024):
+        """
+        Cost matrix that is held in memory, for using the block-wise solver
+        (e.g. for warm starts) with a precomputed cost matrix
+
+        Args:
+            cost_matrix: array or tensor of shape (N, M), or (batch_size, N, M)
+                for a different cost matrix per batch element
+            block_size (int): number of rows of the cost matrix that are used
+                at once
+        """
+        if isinstance(cost_matrix, np.ndarray):
+            cost_matrix = torch.from_numpy(cost_matrix)
+        self.cost_matrix = cost_matrix
+        self.block_size = block_size
+        self.scale = 1.0
+
+    @property
+    def shape(self):
+        return tuple(self.cost_matrix.shape[-2:])
+
+    def to(self, device=None, dtype=None):
+        self.cost_matrix = self.cost_matrix.to(device=device, dtype=dtype)
+        return self
+
+    def max(self):
+        return torch.max(self.cost_matrix).item() * self.scale
+
+    def select(self, index):
+        """
+        Per-batch costs of the batch elements in index (e.g. the elements of
+        a chunk, or each element repeated per time step)
+
+        Args:
+            index: tensor of batch indices
+        Returns:
+            DenseCost: costs of shape (len(index), N, M)
+        """
+        selected = DenseCost(
+            self.cost_matrix[index.to(self.cost_matrix.device)], self.block_size
+        )
+        selected.scale = self.scale
+        return selected
+
+    def cost_block(self, start, end, transpose=False):
+        cost_matrix = self.cost_matrix
+        if transpose:
+            cost_matrix = cost_matrix.transpose(-2, -1)
+        return cost_matrix[..., start:end, :] * self.scale
+
+
+class CoordinateCost(CostOperator):
+    def __init__(self, coords, speed_factor=None, power=1, block_size=1024):
+        """
+        Costs between locations computed from their coordinates, equivalent to
+        space_cost_matrix(coords, speed_factor=speed_factor,
+        scale_function=lambda x: x**power)
+
+        Args:
+            coords: spatial coordinates (projected, distances in m) of shape (N, 2)
+            speed_factor: speed (in km/h) for converting distances to time
+            power (float): exponent applied to the distance or time
+            block_size (int): number of rows of the cost matrix that are
+                computed at once. Memory grows with batch_size * block_size * N.
+        """
+        if isinstance(coords, np.ndarray):
+            coords = torch.from_numpy(coords)
+        self.coords = coords
+        self.speed_factor = speed_factor
+        self.power = power
+        self.block_size = block_size
+        self.scale = 1.0
+
+    @property
+    def shape(self):
+        return (len(self.coords), len(self.coords))
+
+    def to(self, device=None, dtype=None):
+        self.coords = self.coords.to(device=device, dtype=dtype)
+        return self
+
+    def cost_block(self, start, end, transpose=False):
+        # symmetric cost, transpose does not matter
+        cost = torch.cdist(self.coords[start:end], self.coords)
+        if self.speed_factor is not None:
+            cost = (cost / 1000) / self.speed_factor
+        if self.power != 1:
+            cost = cost**self.power
+        return cost * self.scale
+
+
+class SpaceTimeCost(CostOperator):
+    def __init__(self, spacetime_cost, block_size=1024):
+        """
+        Block-wise costs of a structured space-time cost matrix
+
+        Args:
+            spacetime_cost (SpaceTimeCostMatrix): spatial costs and waiting times
+            block_size (int): number of rows of the cost matrix that are
+                computed at once
+        """
+        self.time_matrix = torch.as_tensor(spacetime_cost.time_matrix)
+        self.waiting_time = torch.as_tensor(spacetime_cost.waiting_time).to(
+            self.time_matrix.dtype
+        )
+        self.time_steps = spacetime_cost.time_steps
+        self.nr_stations = spacetime_cost.nr_stations
+        self.block_size = block_size
+        self.scale = 1.0
+
+    @property
+    def shape(self):
+        size = self.time_steps * self.nr_stations
+        return (size, size)
+
+    def to(self, device=None, dtype=None):
+        self.time_matrix = self.time_matrix.to(device=device, dtype=dtype)
+        self.waiting_time = self.waiting_time.to(device=device, dtype=dtype)
+        return self
+
+    def max(self):
+        max_cost = max(torch.max(self.time_matrix), torch.max(self.waiting_time))
+        return max_cost.item() * self.scale
+
+    def cost_block(self, start, end, transpose=False):
+        time_matrix, waiting_time = self.time_matrix, self.waiting_time
+        if transpose:
+            time_matrix, waiting_time = time_matrix.T, waiting_time.T
+        # row i is timeslot i // nr_stations and station i % nr_stations
+        rows = torch.arange(start, end, device=time_matrix.device)
+        space_cost = time_matrix[rows % self.nr_stations].repeat(1, self.time_steps)
+        wait_cost = waiting_time[rows // self.nr_stations].repeat_interleave(
+            self.nr_stations, dim=1
+        )
+        return torch.maximum(space_cost, wait_cost) * self.scale
+
+
+def softmin(eps, cost, h, transpose=False):
+    """
+    Soft-C-transform f_i = -eps * log sum_j exp(h_j - C_ij / eps), computed on
+    one block of rows of the cost matrix at a time
+
+    Args:
+        eps (float): temperature
+        cost (CostOperator): costs between the locations
+        h (torch.Tensor): log-domain dual values of shape (batch_size, M)
+        transpose (bool): Whether to use the transposed cost matrix
+    """
+    n_rows = cost.shape[1] if transpose else cost.shape[0]
+    out = []
+    for start in range(0, n_rows, cost.block_size):
+        end = min(start + cost.block_size, n_rows)
+        cost_block = cost.cost_block(start, end, transpose)
+        out.append(-eps * torch.logsumexp(h.unsqueeze(-2) - cost_block / eps, dim=-1))
+    return torch.cat(out, dim=-1)
+
+
+def log_weights(a):
+    return torch.where(a > 0, torch.log(a), torch.full_like(a, -100000))
+
+
+def epsilon_schedule(p, diameter, blur, scaling):
+    """Temperatures for eps-scaling (same schedule as in geomloss)"""
+    return (
+        [diameter**p]
+        + [
+            np.exp(e)
+            for e in np.arange(
+                p * np.log(diameter), p * np.log(blur), p * np.log(scaling)
+            )
+        ]
+        + [blur**p]
+    )
+
+
+def dampening(eps, rho):
+    return 1 if rho is None else 1 / (1 + eps / rho)
+
+
+def sinkhorn_divergence(
+    a,
+    b,
+    cost,
+    blur=0.05,
+    reach=None,
+    scaling=0.5,
+    p=2,
+    diameter=None,
+    debias=True,
+    potentials=None,
+    warm_iterations=2,
+    tol=None,
+    max_iter=100,
+    log=False,
+):
+    """
+    Debiased Sinkhorn divergence between the weights a and b on a fixed set of
+    locations, with eps-scaling and unbalanced (reach) mode as in geomloss, but
+    on a CostOperator that never materialises the cost matrix.
+
+    Args:
+        a (torch.Tensor): weights of shape (batch_size, N)
+        b (torch.Tensor): weights of shape (batch_size, M)
+        cost (CostOperator): costs between the locations. A DenseCost with a
+            cost matrix of shape (batch_size, N, M) gives each batch element
+            its own costs.
+        blur, reach, scaling, p: see geomloss.SamplesLoss. The temperature is
+            eps = blur**p and the strength of the marginal constraints is
+            rho = reach**p (balanced OT if reach is None).
+        diameter (float, optional): Upper bound on the costs**(1/p), start of
+            the eps-scaling. Defaults to the maximum cost**(1/p).
+        debias (bool): Whether to subtract the self-transport terms.
+        potentials (tuple, optional): dual potentials (f_ba, g_ab, f_aa, g_bb)
+            of a previous solve (e.g. of the previous training iteration) that
+            are used as initialisation. The eps-scaling is then skipped.
+        warm_iterations (int): number of iterations at the final temperature
+            when starting from the given potentials
+        tol (float, optional): If given, the iterations continue at the final
+            temperature until the potentials change by less than tol (maximum
+            absolute change over the batch), or max_iter iterations are done.
+            By default, only the eps-scaling is run (as in geomloss).
+        max_iter (int): maximum number of iterations if tol is given
+        log (bool): Whether to also return a dict with the (detached) dual
+            potentials for warm-starting the next solve, the number of
+            iterations and the last change of the potentials
+
+    Returns:
+        torch.Tensor: Sinkhorn divergence of shape (batch_size,), and the log
+            dict if log=True
+    """
+    if diameter is None:
+        diameter = cost.max() ** (1 / p)
+    eps_list = epsilon_schedule(p, diameter, blur, scaling)
+    rho = None if reach is None else reach**p
+    a_log, b_log = log_weights(a), log_weights(b)
+
+    def sinkhorn_step(eps, f_ba, g_ab, f_aa, g_bb):
+        """One symmetric Sinkhorn update of all potentials"""
+        damping = dampening(eps, rho)
+        ft_ba = damping * softmin(eps, cost, b_log + g_ab / eps)
+        gt_ab = damping * softmin(eps, cost, a_log + f_ba / eps, transpose=True)
+        f_ba, g_ab = 0.5 * (f_ba + ft_ba), 0.5 * (g_ab + gt_ab)
+        if debias:
+            ft_aa = damping * softmin(eps, cost, a_log + f_aa / eps)
+            gt_bb = damping * softmin(eps, cost, b_log + g_bb / eps, transpose=True)
+            f_aa, g_bb = 0.5 * (f_aa + ft_aa), 0.5 * (g_bb + gt_bb)
+        return f_ba, g_ab, f_aa, g_bb
+
+    # compute the dual potentials without gradients, and only track the
+    # gradients in the last extrapolation step (as in geomloss)
+    with torch.no_grad():
+        if potentials is None:
+            eps = eps_list[0]
+            damping = dampening(eps, rho)
+            g_ab = damping * softmin(eps, cost, a_log, transpose=True)
+            f_ba = damping * softmin(eps, cost, b_log)
+            f_aa, g_bb = None, None
+            if debias:
+                f_aa = damping * softmin(eps, cost, a_log)
+                g_bb = damping * softmin(eps, cost, b_log, transpose=True)
+        else:
+            # the previous potentials are close to the new optimum, such that
+            # the eps-scaling is not needed
+            f_ba, g_ab, f_aa, g_bb = potentials
+            eps_list = eps_list[-1:] * warm_iterations
+
+        iterations, error = 0, np.inf
+        for eps in eps_list:
+            f_ba, g_ab, f_aa, g_bb = sinkhorn_step(eps, f_ba, g_ab, f_aa, g_bb)
+            iterations += 1
+        # continue at the final temperature until convergence
+        while tol is not None and iterations < max_iter:
+            previous = (f_ba, g_ab, f_aa, g_bb)
+            f_ba, g_ab, f_aa, g_bb = sinkhorn_step(eps, f_ba, g_ab, f_aa, g_bb)
+            iterations += 1
+            error = max(
+                torch.max(torch.abs(new - old)).item()
+                for new, old in zip((f_ba, g_ab, f_aa, g_bb), previous)
+                if new is not None
+            )
+            if error < tol:
+                break
+
+    # last extrapolation: the potentials are detached, so the gradients only
+    # flow through a and b and no cost block is kept for the backward pass
+    damping = dampening(eps, rho)
+    f_ba, g_ab = (
+        damping * softmin(eps, cost, (b_log + g_ab / eps).detach()),
+        damping * softmin(eps, cost, (a_log + f_ba / eps).detach(), transpose=True),
+    )
+    if debias:
+        f_aa = damping * softmin(eps, cost, (a_log + f_aa / eps).detach())
+        g_bb = damping * softmin(eps, cost, (b_log + g_bb / eps).detach(), True)
+    else:
+        f_aa, g_bb = torch.zeros_like(f_ba), torch.zeros_like(g_ab)
+
+    if rho is None:
+        loss = torch.sum(a * (f_ba - f_aa), dim=-1) + torch.sum(
+            b * (g_ab - g_bb), dim=-1
+        )
+    else:
+        weight = rho + eps / 2
+        loss = torch.sum(
+            a * weight * (torch.exp(-f_aa / rho) - torch.exp(-f_ba / rho)), dim=-1
+        ) + torch.sum(
+            b * weight * (torch.exp(-g_bb / rho) - torch.exp(-g_ab / rho)), dim=-1
+        )
+    if log:
+        potentials = (f_ba.detach(), g_ab.detach())
+        potentials += (f_aa.detach(), g_bb.detach()) if debias else (None, None)
+        return loss, {
+            "potentials": potentials,
+            "iterations": iterations,
+            "error": error,
+        }
+    return loss
@@ -0,0 +1,132 @@
+from contextlib import ExitStack
+from itertools import zip_longest
+import numpy as np
+import pandas as pd
+from geot.partialot import PartialOT
+from geot.plans import PlanWriter
+
+
+def read_chunks(path, chunksize=1000, timestamp_col="timestamp"):
+    """
+    Read a table of shape (timestamps x stations) in chunks of rows
+
+    Args:
+        path (str): CSV or Parquet file (.parquet / .pq, requires pyarrow) with
+            one column with the timestamps and one column per station
+        chunksize (int): number of rows per chunk
+        timestamp_col (str): name of the column with the timestamps
+    Yields:
+        pd.DataFrame: chunk with the timestamps as index and the station ids
+            (as strings) as columns
+    """
+    if str(path).endswith((".parquet", ".pq")):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet files in chunks requires pyarrow")
+        reader = pq.ParquetFile(path)
+        chunks = (
+            batch.to_pandas() for batch in reader.iter_batches(batch_size=chunksize)
+        )
+    else:
+        reader = chunks = pd.read_csv(path, chunksize=chunksize)
+    try:
+        for chunk in chunks:
+            chunk = chunk.set_index(timestamp_col)
+            chunk.columns = chunk.columns.astype(str)
+            yield chunk
+    finally:
+        # also close the file if the generator is not exhausted
+        reader.close()
+
+
+def stream_ot_errors(
+    pred_path,
+    obs_path,
+    cost_matrix,
+    station_ids,
+    chunksize=1000,
+    timestamp_col="timestamp",
+    return_plans=False,
+    output_path=None,
+    plans_path=None,
+    **kwargs_partialot,
+):
+    """
+    Compute the OT error per timestep for large archives of predictions and
+    observations, reading both files chunk by chunk
+
+    Args:
+        pred_path (str): CSV or Parquet file with predictions (timestamp x station)
+        obs_path (str): CSV or Parquet file with observations, with the same
+            timestamps in the same order as pred_path
+        cost_matrix: cost matrix between the stations, in the order of station_ids
+        station_ids (list): column names of the stations in the order of the rows
+            of cost_matrix. Other columns are ignored.
+        chunksize (int): number of timesteps that are loaded and solved at once
+        timestamp_col (str): name of the column with the timestamps
+        return_plans (bool): Whether to also yield the OT matrix as scipy sparse
+            array of shape (N+1, N+1)
+        output_path (str, optional): CSV file to which the errors are appended
+            after each chunk
+        plans_path (str, optional): file to which the OT matrices are appended
+            (see geot.plans.PlanWriter and geot.plans.read_plans)
+        kwargs_partialot: other arguments for PartialOT, e.g. n_workers
+    Yields:
+        tuple: (timestamp, OT error) or (timestamp, OT error, OT matrix)
+    """
+    station_ids = [str(station) for station in station_ids]
+    write_header = True
+    nr_nodes = len(station_ids) + 1
+    compute_plans = return_plans or plans_path is not None
+    # the readers, the solver and the plan writer are closed on errors and if
+    # the caller stops early
+    with ExitStack() as stack:
+        ot_obj = PartialOT(cost_matrix, **kwargs_partialot)
+        stack.callback(ot_obj.close)
+        pred_chunks = read_chunks(pred_path, chunksize, timestamp_col)
+        stack.callback(pred_chunks.close)
+        obs_chunks = read_chunks(obs_path, chunksize, timestamp_col)
+        stack.callback(obs_chunks.close)
+        plan_writer = (
+            None
+            if plans_path is None
+            else stack.enter_context(PlanWriter(plans_path, (nr_nodes,) * 2))
+        )
+        missing = object()
+        for pred_chunk, obs_chunk in zip_longest(
+            pred_chunks, obs_chunks, fillvalue=missing
+        ):
+            if pred_chunk is missing or obs_chunk is missing:
+                raise ValueError(
+                    "Predictions and observations have a different number of rows"
+                )
+            if not pred_chunk.index.equals(obs_chunk.index):
+                raise ValueError("Timestamps of predictions and observations differ")
+            # align the stations to the order of the cost matrix
+            predictions = np.ascontiguousarray(pred_chunk[station_ids], dtype=float)
+            observations = np.ascontiguousarray(obs_chunk[station_ids], dtype=float)
+
+            if compute_plans:
+                plans = ot_obj(predictions, observations, return_matrix="sparse")
+                # PartialOT drops the batch axis for a single timestep
+                plans = [plans] if len(predictions) == 1 else plans
+                # compute the errors from the plans instead of solving again
+                errors = [ot_obj.plan_cost(plan) for plan in plans]
+                if plan_writer is not None:
+                    for plan in plans:
+                        plan_writer.write(plan)
+            else:
+                errors = np.atleast_1d(ot_obj(predictions, observations))
+
+            if output_path is not None:
+                pd.DataFrame({"ot_error": errors}, index=pred_chunk.index).to_csv(
+                    output_path, mode="w" if write_header else "a", header=write_header
+                )
+                write_header = False
+
+            for i, timestamp in enumerate(pred_chunk.index):
+                if return_plans:
+                    yield timestamp, errors[i], plans[i]
+                else:
+                    yield timestamp, errors[i]
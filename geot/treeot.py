@@ -0,0 +1,136 @@
+import numpy as np
+from scipy.sparse import csr_array
+from scipy.stats import pearsonr, spearmanr
+from geot.partialot import PartialOT
+
+
+class TreeOT:
+    def __init__(self, coords, penalty_waste="max", speed_factor=None, max_depth=20):
+        """
+        Fast approximation of the (partial) OT error with Euclidean costs by the
+        Wasserstein distance on a quadtree of the locations. On a tree, the OT
+        error is the sum over the edges of the edge length times the absolute
+        difference of the masses below the edge, so one evaluation costs
+        O(N * depth) instead of a network simplex solve.
+
+        The edge from a cell to its parent has half the length of the diagonal
+        of the parent cell, so tree distances are never shorter than Euclidean
+        distances and the result is an upper bound of the exact OT error (see
+        compare_to_exact for the correlation on real data).
+
+        Args:
+            coords (np.ndarray): coordinates of the N locations, shape (N, d)
+            penalty_waste (float or "max"): cost of importing or exporting mass,
+                as in PartialOT. "max" is the diagonal of the bounding box of
+                coords, an upper bound of the maximum distance.
+            speed_factor: speed (in km/h) for converting distances to time, as
+                in geot.cost.space_cost_matrix
+            max_depth (int): maximum depth of the quadtree. Different locations
+                that share a cell at max_depth are connected to it by an edge of
+                half the cell diagonal.
+        """
+        coords = np.asarray(coords, dtype=float)
+        nr_locations, dim = coords.shape
+        lower = np.min(coords, axis=0)
+        side = max(np.max(coords - lower), np.finfo(float).tiny)
+        # relative position in the root cell
+        positions = np.minimum((coords - lower) / side, 1 - 1e-12)
+        root_diagonal = side * np.sqrt(dim)
+        if speed_factor is not None:
+            root_diagonal /= 1000 * speed_factor
+        if penalty_waste == "max":
+            penalty_waste = root_diagonal
+        self.penalty_waste = penalty_waste
+        self.nr_locations = nr_locations
+
+        # one row per tree edge: its length, and the locations below it
+        rows, cols, lengths = [], [], []
+        nr_edges = 0
+        _, distinct_index = np.unique(coords, axis=0, return_inverse=True)
+        distinct_index = distinct_index.reshape(-1)
+        nr_distinct = np.max(distinct_index) + 1
+        for level in range(1, max_depth + 1):
+            cells = np.floor(positions * 2**level).astype(np.int64)
+            _, cell_index = np.unique(cells, axis=0, return_inverse=True)
+            cell_index = cell_index.reshape(-1)
+            nr_cells = np.max(cell_index) + 1
+            rows.append(nr_edges + cell_index)
+            cols.append(np.arange(nr_locations))
+            lengths.append(np.full(nr_cells, root_diagonal / 2**level))
+            nr_edges += nr_cells
+            if nr_cells == nr_distinct:
+                # every location has its own cell
+                break
+        # distinct locations that share the finest cell get their own edge
+        first = np.unique(distinct_index, return_index=True)[1]
+        shared = np.bincount(cell_index[first], minlength=nr_cells)[cell_index] > 1
+        rows.append(nr_edges + distinct_index[shared])
+        cols.append(np.where(shared)[0])
+        lengths.append(np.full(nr_distinct, root_diagonal / 2**level / 2))
+        nr_edges += nr_distinct
+        # the waste node is connected to the root
+        rows.append([nr_edges])
+        cols.append([nr_locations])
+        lengths.append([penalty_waste])
+        nr_edges += 1
+
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        lengths = np.concatenate(lengths)
+        self.depth = level
+        # weighted_subtrees @ masses: length of each edge times the mass below
+        self.weighted_subtrees = csr_array(
+            (lengths[rows], (rows, cols)), shape=(nr_edges, nr_locations + 1)
+        )
+
+    def __call__(self, y_pred, y_true):
+        """
+        Approximate OT error between y_pred and y_true
+
+        Args:
+            y_pred: array with predictions, shape (batch_size, N) or (N,)
+            y_true: array with observations, shape (batch_size, N) or (N,)
+        Returns:
+            float or np.ndarray of shape (batch_size,)
+        """
+        y_pred, y_true = np.asarray(y_pred), np.asarray(y_true)
+        single = y_pred.ndim == 1
+        y_pred, y_true = np.atleast_2d(y_pred), np.atleast_2d(y_true)
+        assert y_pred.shape == y_true.shape and y_pred.shape[1] == self.nr_locations
+        # columns: difference per location and the imported minus exported mass
+        diff = np.empty((self.nr_locations + 1, len(y_pred)))
+        diff[:-1] = (y_pred - y_true).T
+        diff[-1] = -np.sum(diff[:-1], axis=0)
+        errors = np.sum(np.abs(self.weighted_subtrees @ diff), axis=0)
+        return errors[0] if single else errors
+
+
+def compare_to_exact(tree_ot, cost_matrix, y_pred, y_true, **kwargs_partialot):
+    """
+    Compare the tree approximation to the exact OT error, e.g. on a sample of
+    the evaluation data
+
+    Args:
+        tree_ot (TreeOT): the approximation
+        cost_matrix (np.ndarray): cost matrix for the exact error, usually
+            space_cost_matrix of the same coordinates and speed_factor
+        y_pred, y_true: arrays of shape (batch_size, N)
+        kwargs_partialot: other arguments for PartialOT. penalty_waste defaults
+            to the penalty of tree_ot.
+    Returns:
+        dict: pearson and spearman correlation, the minimum, mean and maximum
+            ratio of approximate to exact error, and whether the approximation
+            was an upper bound for all samples
+    """
+    kwargs_partialot.setdefault("penalty_waste", tree_ot.penalty_waste)
+    exact = np.atleast_1d(PartialOT(cost_matrix, **kwargs_partialot)(y_pred, y_true))
+    approx = np.atleast_1d(tree_ot(y_pred, y_true))
+    nonzero = exact > 0
+    ratio = approx[nonzero] / exact[nonzero]
+    return {
+        "pearson": pearsonr(approx, exact)[0] if len(exact) > 1 else np.nan,
+        "spearman": spearmanr(approx, exact)[0] if len(exact) > 1 else np.nan,
+        "min_ratio": np.min(ratio) if len(ratio) else np.nan,
+        "mean_ratio": np.mean(ratio) if len(ratio) else np.nan,
+        "max_ratio": np.max(ratio) if len(ratio) else np.nan,
+        "upper_bound": bool(np.all(approx >= exact * (1 - 1e-9))),
+    }
@@ -0,0 +1,103 @@
+import numpy as np
+from geot.cache import CostMatrixCache, SolverCache
+from geot.partialot import PartialOT, partial_ot_paired, solver_cache
+from geot.cost import (
+    space_cost_matrix,
+    spacetime_cost_matrix,
+    sparse_space_cost_matrix,
+)
+
+
+class TestCostMatrixCache:
+    def test_cache_hit(self, tmp_path):
+        np.random.seed(0)
+        locations = np.random.rand(10, 2) * 1000
+        cache = CostMatrixCache(str(tmp_path))
+        cost_matrix = cache.space_cost_matrix(
+            locations, speed_factor=5, scale_function="square"
+        )
+        cached = cache.space_cost_matrix(
+            locations, speed_factor=5, scale_function="square"
+        )
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert isinstance(cached, np.memmap)
+        expected = space_cost_matrix(
+            locations, speed_factor=5, scale_function=lambda x: x**2
+        )
+        assert np.allclose(cost_matrix, expected) and np.allclose(cached, expected)
+
+        # the space-time matrix reuses the cached spatial matrix
+        spacetime = cache.spacetime_cost_matrix(
+            locations, speed_factor=5, scale_function="square", time_steps=2
+        )
+        assert cache.hits == 2
+        assert np.allclose(spacetime, spacetime_cost_matrix(expected, time_steps=2))
+
+    def test_eviction(self, tmp_path):
+        # room for about two 20x20 matrices
+        cache = CostMatrixCache(str(tmp_path), max_bytes=2 * 20 * 20 * 8 + 500)
+        for seed in range(4):
+            cache.space_cost_matrix(np.random.rand(20, 2) + seed)
+        assert len(list(tmp_path.glob("*.npy"))) == 2
+
+
+class TestSolverCache:
+    def test_lru(self):
+        cache = SolverCache(maxsize=2)
+        cost_matrices = [np.random.rand(4, 4) for _ in range(3)]
+        solver = cache.get(PartialOT, cost_matrices[0], penalty_waste=0)
+        assert cache.get(PartialOT, cost_matrices[0], penalty_waste=0) is solver
+        # different parameters or cost matrix give a new solver
+        assert cache.get(PartialOT, cost_matrices[0], penalty_waste=1) is not solver
+        cache.get(PartialOT, cost_matrices[1])
+        assert cache.cache_info() == {"hits": 1, "misses": 3, "size": 2, "maxsize": 2}
+        # the least recently used solver was evicted
+        assert cache.get(PartialOT, cost_matrices[0], penalty_waste=0) is not solver
+        # changed values give a new solver
+        cost_matrices[1][0, 0] = 5
+        cache.get(PartialOT, cost_matrices[1])
+        assert cache.hits == 1
+
+    def test_in_place_change(self):
+        """Test that changing any entry of the matrix gives a new solver"""
+        solver_cache.clear()
+        np.random.seed(3)
+        cost_matrix = np.random.rand(100, 100) * 10
+        pred, gt = np.random.rand(1, 100), np.random.rand(1, 100)
+        partial_ot_paired(cost_matrix, pred, gt)
+        cost_matrix[:, 1::2] = 0
+        error = partial_ot_paired(cost_matrix, pred, gt)
+        assert np.isclose(error, PartialOT(cost_matrix)(pred, gt))
+        assert solver_cache.hits == 0
+
+    def test_close_on_eviction(self):
+        """Test that the worker pools of evicted solvers are shut down"""
+        cache = SolverCache(maxsize=1)
+        pred, gt = np.random.rand(4, 5), np.random.rand(4, 5)
+        solver = cache.get(PartialOT, np.random.rand(5, 5), n_workers=2)
+        solver(pred, gt)
+        assert solver._pool is not None
+        cache.get(PartialOT, np.random.rand(5, 5), n_workers=2)(pred, gt)
+        assert solver._pool is None
+        cache.clear()
+        assert len(cache.solvers) == 0
+
+    def test_functional_api(self):
+        solver_cache.clear()
+        cost_matrix = np.random.rand(5, 5)
+        pred, gt = np.random.rand(1, 5), np.random.rand(1, 5)
+        first = partial_ot_paired(cost_matrix, pred, gt, penalty_waste=0)
+        second = partial_ot_paired(cost_matrix, pred, gt, penalty_waste=0)
+        assert first == second
+        assert (solver_cache.hits, solver_cache.misses) == (1, 1)
+
+    def test_cost_objects(self):
+        """Test that cost objects that are not arrays never hit a stale solver"""
+        solver_cache.clear()
+        pred, gt = np.random.rand(1, 30), np.random.rand(1, 30)
+        for seed in range(20):
+            locations = np.random.default_rng(seed).random((30, 2)) * 1000
+            sparse_cost = sparse_space_cost_matrix(locations, k=5)
+            error = partial_ot_paired(sparse_cost, pred, gt, penalty_waste="max")
+            assert np.isclose(error, PartialOT(sparse_cost)(pred, gt))
+            del sparse_cost
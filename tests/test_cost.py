@@ -0,0 +1,92 @@
+import numpy as np
+from geot.cost import (
+    SpaceTimeCostMatrix,
+    blockwise_space_cost_matrix,
+    network_cost_matrix,
+    road_graph,
+    snap_to_nodes,
+    space_cost_matrix,
+)
+from geot.partialot import PartialOT
+
+
+def grid_network(size, spacing=100):
+    """Two-way road grid with size x size nodes"""
+    node_coords = np.stack(np.meshgrid(np.arange(size), np.arange(size)), -1)
+    node_coords = node_coords.reshape(-1, 2) * spacing
+    nodes = np.arange(size * size).reshape(size, size)
+    pairs = np.concatenate(
+        [
+            np.stack([nodes[:, :-1].ravel(), nodes[:, 1:].ravel()], 1),
+            np.stack([nodes[:-1].ravel(), nodes[1:].ravel()], 1),
+        ]
+    )
+    pairs = np.concatenate([pairs, pairs[:, ::-1]])
+    edges = np.concatenate([pairs, np.full((len(pairs), 1), spacing)], axis=1)
+    return node_coords, edges
+
+
+class TestNetworkCost:
+    def test_grid_distances(self):
+        """Test that shortest paths on a grid are Manhattan distances"""
+        node_coords, edges = grid_network(6)
+        np.random.seed(9)
+        stations = np.random.rand(10, 2) * 500
+        station_nodes = snap_to_nodes(stations, node_coords)
+        manhattan = np.abs(
+            node_coords[station_nodes, np.newaxis] - node_coords[station_nodes]
+        ).sum(-1)
+        # parallel edges: only the shortest is kept
+        longer_edges = edges.copy()
+        longer_edges[:, 2] = 1000
+        graph = road_graph(np.concatenate([longer_edges, edges]))
+        cost_matrix = network_cost_matrix(graph, station_nodes, chunk_size=3)
+        assert np.allclose(cost_matrix, manhattan)
+        parallel = network_cost_matrix(
+            edges, station_nodes, speed_factor=10, n_workers=2, chunk_size=3
+        )
+        assert np.allclose(parallel, manhattan / 1000 / 10)
+        # one search at a time if the lengths to all nodes exceed the memory
+        one_by_one = network_cost_matrix(graph, station_nodes, max_memory=1)
+        assert np.allclose(one_by_one, manhattan)
+
+        # pairs beyond the cutoff get the cutoff
+        bounded = network_cost_matrix(graph, station_nodes, cutoff=300)
+        assert np.allclose(bounded, np.minimum(manhattan, 300))
+        # the matrix plugs into PartialOT and the space-time costs
+        pred, gt = np.random.rand(2, 10), np.random.rand(2, 10)
+        assert np.all(PartialOT(cost_matrix)(pred, gt) > 0)
+        spacetime = SpaceTimeCostMatrix(cost_matrix, time_steps=2)
+        assert spacetime.toarray().shape == (20, 20)
+
+
+class TestBlockwiseCost:
+    def test_same_as_dense(self, tmp_path):
+        """Test that the blockwise matrix equals space_cost_matrix"""
+        np.random.seed(3)
+        coords = np.random.rand(50, 2) * 1000
+        dense = space_cost_matrix(coords, speed_factor=10, scale_function=np.sqrt)
+        blockwise = blockwise_space_cost_matrix(
+            coords, speed_factor=10, scale_function=np.sqrt, block_size=7, n_workers=2
+        )
+        assert np.allclose(blockwise, dense)
+        # float32 into a memory-mapped file
+        path = str(tmp_path / "cost.npy")
+        blockwise_space_cost_matrix(
+            coords, coords[:20], dtype=np.float32, out=path, block_size=16
+        )
+        loaded = np.load(path, mmap_mode="r")
+        assert loaded.dtype == np.float32
+        assert np.allclose(loaded, space_cost_matrix(coords, coords[:20]), rtol=1e-6)
+
+    def test_haversine(self):
+        """Test great-circle distances against known values"""
+        # (lat, lon) of Zurich and Bern, and two points on the equator
+        coords = np.array([[47.3769, 8.5417], [46.9480, 7.4474], [0, 0], [0, 1]])
+        cost_matrix = blockwise_space_cost_matrix(
+            coords, metric="haversine", block_size=3
+        )
+        assert np.allclose(cost_matrix, cost_matrix.T)
+        assert abs(cost_matrix[0, 1] / 1000 - 95.5) < 1
+        # one degree of longitude on the equator
+        assert np.isclose(cost_matrix[2, 3], 6371000 * np.pi / 180)
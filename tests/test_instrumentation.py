@@ -0,0 +1,43 @@
+import numpy as np
+import torch
+from geot.instrumentation import instrument, stage
+from geot.partialot import PartialOT
+from geot.sinkhorn_loss import SinkhornLoss
+
+
+class TestInstrumentation:
+    def test_stages_and_counters(self, tmp_path):
+        np.random.seed(0)
+        cost_matrix = np.random.rand(10, 10)
+        y_pred, y_true = np.random.rand(3, 10), np.random.rand(3, 10)
+        events = []
+        with instrument(lambda *event: events.append(event)) as instrumentation:
+            PartialOT(cost_matrix)(y_pred, y_true)
+            SinkhornLoss(cost_matrix, backend="native")(
+                torch.rand(2, 10), torch.rand(2, 10)
+            )
+        report = instrumentation.report()
+        for name in ["partialot.extend", "partialot.solve", "sinkhorn.solve"]:
+            assert report["stages"][name]["calls"] == 1
+        assert report["counters"]["partialot.exact_solves"] == 3
+        assert report["counters"]["sinkhorn.batch_size"] == 2
+        assert report["counters"]["sinkhorn.iterations"] > 0
+        # every measurement was passed to the sink
+        assert ("count", "partialot.calls", 1) in events
+        assert len(events) == len([e for e in events if e[0] == "count"]) + sum(
+            stage["calls"] for stage in report["stages"].values()
+        )
+        path = str(tmp_path / "geot.prom")
+        instrumentation.to_prometheus(path)
+        with open(path, "r") as infile:
+            text = infile.read()
+        assert 'geot_stage_calls_total{stage="partialot.solve"} 1' in text
+
+    def test_disabled(self):
+        """Test that nothing is recorded outside of instrument()"""
+        with instrument() as instrumentation:
+            pass
+        PartialOT(np.random.rand(5, 5))(np.random.rand(5), np.random.rand(5))
+        with stage("outside"):
+            pass
+        assert instrumentation.report() == {"stages": {}, "counters": {}}
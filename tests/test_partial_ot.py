@@ -1,10 +1,32 @@
 # test with differet datatypes
 # test that it is the same as balanced OT for balanced data
 # test with different input types and shapes
+import subprocess
+import sys
 import numpy as np
+import pytest
 import torch
-from geot.partialot import PartialOT, partial_ot_paired
-from geot.cost import space_cost_matrix, spacetime_cost_matrix
+import ot
+from scipy.spatial.distance import cdist
+from geot.partialot import (
+    MultiscalePartialOT,
+    PartialOT,
+    PartialOTBounds,
+    RollingPartialOT,
+    partial_ot_paired,
+    partial_ot_unpaired,
+    rank_models,
+)
+from geot.cost import (
+    space_cost_matrix,
+    spacetime_cost_matrix,
+    sparse_space_cost_matrix,
+    IncrementalCostMatrix,
+    SpaceTimeCostMatrix,
+    TimeExpandedGraph,
+)
+from geot.instrumentation import instrument
+from geot.sinkhorn_solver import SpaceTimeCost
 
 test_cdist = np.array(
     [
@@ -52,6 +74,14 @@ class TestPartialOT:
             penalty_waste=0,
             return_matrix=True,
         )
+        sparse_matrix = partial_ot_paired(
+            test_cdist,
+            test_pred,
+            test_gt,
+            penalty_waste=0,
+            return_matrix="sparse",
+        )
+        assert np.allclose(sparse_matrix.toarray(), ot_matrix)
         assert np.isclose(ot_error, 0.29016712)
         assert np.isclose(ot_error, np.sum(ot_matrix[:-1, :-1] * test_cdist))
         assert np.isclose(ot_error, function_computation)
@@ -91,3 +121,333 @@ class TestPartialOT:
         )
         ot_error = ot_computer(observations, predictions)
         assert np.isclose(ot_error.item(), -1.30734241547381)
+
+    def test_batched_exact(self):
+        """Test that batched exact OT equals solving each row separately"""
+        np.random.seed(0)
+        batch_pred = np.random.rand(6, 4)
+        batch_gt = np.random.rand(6, 4)
+        single_errors = [
+            PartialOT(test_cdist)(batch_pred[i], batch_gt[i]) for i in range(6)
+        ]
+        for executor in ["thread", "process"]:
+            ot_obj = PartialOT(test_cdist, n_workers=2, executor=executor)
+            ot_errors = ot_obj(batch_pred, batch_gt)
+            ot_matrices = ot_obj(batch_pred, batch_gt, return_matrix=True)
+            # the extended buffers are reused by the next call
+            swapped_errors = ot_obj(batch_gt, batch_pred)
+            ot_obj.close()
+            assert np.allclose(
+                swapped_errors, PartialOT(test_cdist)(batch_gt, batch_pred)
+            )
+            assert ot_errors.shape == (6,)
+            assert ot_matrices.shape == (6, 5, 5)
+            assert np.allclose(ot_errors, single_errors)
+
+    def test_rectangular_cost(self):
+        """Test cost matrices between different numbers of locations"""
+        np.random.seed(2)
+        cost_matrix = np.random.rand(3, 5)
+        y_pred, y_true = np.random.rand(4, 3), np.random.rand(4, 5)
+        ot_obj = PartialOT(cost_matrix, penalty_waste=1)
+        ot_errors = ot_obj(y_pred, y_true)
+        # reference: pad the masses with the imported or exported mass
+        for i in range(4):
+            diff = np.sum(y_pred[i]) - np.sum(y_true[i])
+            extended_cost = np.ones((4, 6))
+            extended_cost[:3, :5] = cost_matrix
+            expected = ot.emd2(
+                np.append(y_pred[i], max(-diff, 0)),
+                np.append(y_true[i], max(diff, 0)),
+                extended_cost,
+            )
+            assert np.isclose(ot_errors[i], expected)
+        assert ot_obj(y_pred, y_true, return_matrix=True).shape == (4, 4, 6)
+
+    def test_sparse_cost(self):
+        """Test that the sparse solver equals the dense solver on the filled matrix"""
+        np.random.seed(1)
+        locations = np.random.rand(30, 2) * 1000
+        sparse_cost = sparse_space_cost_matrix(locations, k=5, speed_factor=5)
+        assert sparse_cost.nnz == 30 * 5
+        batch_pred, batch_gt = np.random.rand(3, 30), np.random.rand(3, 30)
+        dense_errors = PartialOT(sparse_cost.toarray())(batch_pred, batch_gt)
+        sparse_errors = PartialOT(sparse_cost)(batch_pred, batch_gt)
+        assert np.allclose(dense_errors, sparse_errors)
+        # the sparse OT matrix has the right marginals and cost
+        ot_matrix = PartialOT(sparse_cost)(
+            batch_pred[0], batch_gt[0], return_matrix=True
+        ).toarray()
+        assert np.allclose(ot_matrix.sum(axis=0)[:-1], batch_gt[0])
+        extended_cost = PartialOT(sparse_cost.toarray()).cost_matrix
+        assert np.isclose(np.sum(ot_matrix * extended_cost), sparse_errors[0])
+
+    def test_structured_spacetime_cost(self):
+        """Test the structured space-time cost against the dense matrix"""
+        np.random.seed(2)
+        time_matrix = space_cost_matrix(np.random.rand(6, 2) * 1000, speed_factor=5)
+        structured = SpaceTimeCostMatrix(
+            time_matrix, time_steps=3, forward_cost=0.1, backward_cost=0.3
+        )
+        dense = spacetime_cost_matrix(
+            time_matrix, time_steps=3, forward_cost=0.1, backward_cost=0.3
+        )
+        assert np.allclose(structured.toarray(), dense)
+        assert np.allclose(structured.block(2, 0), dense[12:, :6])
+        vector = np.random.rand(18)
+        assert np.allclose(structured.dot(vector), dense @ vector)
+        assert np.allclose(structured.dot(vector, transpose=True), dense.T @ vector)
+        assert np.allclose(
+            structured.kernel_dot(vector, 0.1), np.exp(-dense / 0.1) @ vector
+        )
+        # block-wise torch costs
+        operator = SpaceTimeCost(structured, block_size=4)
+        assert np.allclose(operator.cost_block(5, 13).numpy(), dense[5:13])
+        assert np.allclose(operator.cost_block(5, 13, True).numpy(), dense.T[5:13])
+
+        pred, gt = np.random.rand(3, 6), np.random.rand(3, 6)
+        ot_error = PartialOT(structured, spatiotemporal=True)(pred, gt)
+        assert np.isclose(ot_error, PartialOT(dense, spatiotemporal=True)(pred, gt))
+
+    def test_time_expanded_graph(self):
+        """Test that min-cost flow on the time-expanded graph equals the OT
+        error with the dense space-time cost matrix"""
+        np.random.seed(7)
+        time_matrix = space_cost_matrix(np.random.rand(7, 2) * 3000, speed_factor=10)
+        pred, gt = np.random.rand(4, 5, 7), np.random.rand(4, 5, 7)
+        for forward_cost, backward_cost in [(0, 1), (0.05, 0.2)]:
+            structured = SpaceTimeCostMatrix(
+                time_matrix, 5, forward_cost=forward_cost, backward_cost=backward_cost
+            )
+            dense_errors = PartialOT(
+                structured, normalize_cost=True, spatiotemporal=True
+            )(pred, gt)
+            graph_errors = PartialOT(
+                TimeExpandedGraph(structured), normalize_cost=True, spatiotemporal=True
+            )(pred, gt)
+            assert np.allclose(graph_errors, dense_errors)
+            # with fewer spatial arcs, the flow can only be more expensive
+            sparse_errors = PartialOT(
+                TimeExpandedGraph(structured, k=2),
+                normalize_cost=True,
+                spatiotemporal=True,
+            )(pred, gt)
+            assert np.all(sparse_errors >= dense_errors - 1e-9)
+
+    def test_incremental_cost_matrix(self):
+        """Test that adding and removing stations updates prepared solvers as
+        if they were created with the new matrix"""
+        np.random.seed(8)
+        costs = IncrementalCostMatrix(np.random.rand(6, 2) * 1000, ids=list("abcdef"))
+        spacetime = SpaceTimeCostMatrix(costs.matrix, 2, 0.1, 0.3)
+        ot_obj = PartialOT(costs.matrix, penalty_waste=500)
+        spacetime_obj = PartialOT(spacetime, penalty_waste=500, spatiotemporal=True)
+        costs.attach(ot_obj)
+        costs.attach(spacetime_obj)
+        costs.remove(["b"])
+        new_indices = costs.add(["g"], np.random.rand(1, 2) * 1000)
+        # the free slot is reused, the other stations keep their index
+        assert new_indices[0] == 1 and costs.indices(["c", "f"]).tolist() == [2, 5]
+        active = costs.indices(list("acdefg"))
+        assert np.allclose(
+            costs.matrix[np.ix_(active, active)],
+            space_cost_matrix(costs.coords[active]),
+        )
+        # the matrix cannot be reallocated while solvers are attached
+        with pytest.raises(ValueError):
+            costs.add(["h"], np.random.rand(1, 2))
+
+        pred = costs.vector(list("acdefg"), np.random.rand(2, 6))
+        gt = costs.vector(list("acdefg"), np.random.rand(2, 6))
+        new_matrix = costs.matrix.copy()
+        assert np.isclose(
+            ot_obj(pred[0], gt[0]),
+            PartialOT(new_matrix, penalty_waste=500)(pred[0], gt[0]),
+        )
+        new_spacetime = SpaceTimeCostMatrix(new_matrix, 2, 0.1, 0.3)
+        assert np.isclose(
+            spacetime_obj(pred, gt),
+            PartialOT(new_spacetime, penalty_waste=500, spatiotemporal=True)(pred, gt),
+        )
+
+    def test_sinkhorn_buffers(self):
+        """Test that the extended tensors of the Sinkhorn loss are reused
+        without gradients, and that gradients of several calls are correct"""
+        torch.manual_seed(1)
+        pred, gt = torch.rand(2, 3, 4, dtype=torch.float64)
+        reference = [
+            PartialOT(test_cdist, entropy_regularized=True)(pred[i], gt[i])
+            for i in range(3)
+        ]
+        ot_obj = PartialOT(test_cdist, entropy_regularized=True)
+        with instrument() as instrumentation:
+            losses = [ot_obj(pred[i : i + 1], gt[i : i + 1]) for i in range(3)]
+        assert instrumentation.counters["partialot.bytes_allocated"] == 2 * 5 * 8
+        assert torch.allclose(torch.stack(losses).flatten(), torch.stack(reference))
+
+        pred.requires_grad_(True)
+        total = ot_obj(pred[:1], gt[:1]).sum() + ot_obj(pred[1:2], gt[1:2]).sum()
+        total.backward()
+        first = pred.grad.clone()
+        pred.grad = None
+        ot_obj(pred[:1], gt[:1]).sum().backward()
+        ot_obj(pred[1:2], gt[1:2]).sum().backward()
+        assert torch.allclose(first, pred.grad)
+
+    def test_rolling_warm_start(self):
+        """Test that warm-started solves give the same errors as cold solves"""
+        np.random.seed(3)
+        locations = np.random.rand(40, 2)
+        cost_matrix = space_cost_matrix(locations)
+        observations = np.random.rand(10, 40)
+        predictions = observations + np.random.rand(10, 40) * 0.1
+        rolling_ot = RollingPartialOT(cost_matrix)
+        rolling_errors = [rolling_ot(p, o) for p, o in zip(predictions, observations)]
+        assert rolling_ot.stats["cold_solves"] == 1
+        assert rolling_ot.stats["warm_solves"] == 9
+        assert np.allclose(
+            rolling_errors, PartialOT(cost_matrix)(predictions, observations)
+        )
+
+    def test_multiscale(self):
+        """Test that the coarse-to-fine solver gives the exact errors"""
+        np.random.seed(5)
+        locations = np.random.rand(120, 2) * 1000
+        cost_matrix = space_cost_matrix(locations)
+        observations = np.random.poisson(2, (4, 120)).astype(float)
+        predictions = np.random.poisson(2, (4, 120)).astype(float)
+        exact = PartialOT(cost_matrix)(predictions, observations)
+        multiscale = MultiscalePartialOT(
+            cost_matrix, nr_clusters=8, neighbors=20, initial_neighbors=3
+        )
+        assert np.allclose(multiscale(predictions, observations), exact)
+        assert multiscale.stats["dense_solves"] == 0
+        # after max_rounds, the dense problem is solved
+        multiscale = MultiscalePartialOT(
+            cost_matrix, neighbors=20, initial_neighbors=1, max_rounds=1
+        )
+        assert np.allclose(multiscale(predictions, observations), exact)
+        assert multiscale.stats["dense_solves"] == 4
+        # clusters from the coordinates, and the OT matrix
+        grid_labels = (locations[:, 0] // 250) * 4 + locations[:, 1] // 250
+        multiscale = MultiscalePartialOT(cost_matrix, labels=grid_labels, neighbors=20)
+        plan = multiscale(predictions[0], observations[0], return_matrix="sparse")
+        assert np.isclose(np.sum(plan * multiscale.cost_matrix), exact[0])
+        # with a tolerance, the gap to the lower bound is at most tol * error
+        approx = MultiscalePartialOT(cost_matrix, neighbors=20, tol=0.05)(
+            predictions, observations
+        )
+        assert np.all(approx >= exact - 1e-9) and np.all(approx <= exact / 0.95)
+
+    def test_bounds(self):
+        """Test that the bounds enclose the exact error and prune the ranking"""
+        np.random.seed(6)
+        cost_matrix = space_cost_matrix(np.random.rand(80, 2) * 1000)
+        observations = np.random.poisson(3, (4, 80)).astype(float)
+        models = [
+            np.clip(observations + np.random.normal(size=(4, 80)) * noise, 0, None)
+            for noise in np.linspace(0.2, 5, 12)
+        ]
+        bounds_obj = PartialOTBounds(cost_matrix, penalty_waste=500)
+        for predictions in models[::4]:
+            lower, upper = bounds_obj.bounds(predictions, observations)
+            exact = PartialOT(cost_matrix, penalty_waste=500)(predictions, observations)
+            assert np.all(lower <= exact + 1e-9) and np.all(exact <= upper + 1e-9)
+            assert np.all(lower > 0)
+
+        result = rank_models(cost_matrix, models, observations, k=2, penalty_waste=500)
+        exact = [
+            np.sum(PartialOT(cost_matrix, penalty_waste=500)(predictions, observations))
+            for predictions in models
+        ]
+        assert list(result["ranking"]) == list(np.argsort(exact)[:2])
+        assert np.sum(result["solved"]) < len(models)
+
+    def test_exact_without_sinkhorn_import(self):
+        """Test that importing the exact solvers loads neither torch nor geomloss,
+        and that exact computation does not load the Sinkhorn loss module"""
+        code = (
+            "import sys, numpy as np; from geot.partialot import partial_ot_paired; "
+            "assert not {'torch', 'geomloss', 'ot'} & set(sys.modules); "
+            "partial_ot_paired(np.ones((2, 2)), np.ones((1, 2)), np.ones((1, 2))); "
+            "assert 'geot.sinkhorn_loss' not in sys.modules"
+        )
+        subprocess.run([sys.executable, "-c", code], check=True)
+
+
+class TestPartialOTUnpaired:
+    def test_same_as_padding(self):
+        """Test that the single import node equals padding the smaller set"""
+        np.random.seed(5)
+        for nr_pred, nr_gt in [(12, 9), (9, 12), (10, 10)]:
+            locations_pred = np.random.rand(nr_pred, 2)
+            locations_gt = np.random.rand(nr_gt, 2)
+            size = max(nr_pred, nr_gt)
+            padded_cost = np.full((size, size), 0.3)
+            padded_cost[:nr_pred, :nr_gt] = cdist(locations_pred, locations_gt)
+            weights = np.ones(size) / size
+            ot_error = partial_ot_unpaired(
+                locations_pred, locations_gt, penalty_waste=0.3
+            )
+            assert np.isclose(ot_error, ot.emd2(weights, weights, padded_cost))
+
+    def test_sparse_candidates(self):
+        """Test that the cutoff gives bounds and the exact error for a large
+        cutoff"""
+        np.random.seed(6)
+        locations_pred = np.random.rand(60, 2)
+        locations_gt = np.random.rand(45, 2)
+        exact = partial_ot_unpaired(locations_pred, locations_gt)
+        for max_cost in [0.1, 0.3, 2]:
+            ot_error, error_estimate = partial_ot_unpaired(
+                locations_pred,
+                locations_gt,
+                max_cost=max_cost,
+                return_error_estimate=True,
+            )
+            assert ot_error - error_estimate <= exact + 1e-9
+            assert ot_error >= exact - 1e-9
+        assert np.isclose(ot_error, exact) and np.isclose(error_estimate, 0)
+        transport_matrix = partial_ot_unpaired(
+            locations_pred, locations_gt, k=5, return_matrix=True
+        )
+        assert transport_matrix.shape == (61, 46)
+        assert np.isclose(transport_matrix.sum(), 1)
+
+    def test_sparse_refinement(self):
+        """Test that the refinement bounds the error and converges to it"""
+        np.random.seed(8)
+        locations_pred = np.random.rand(300, 2)
+        locations_gt = np.random.rand(250, 2)
+        for penalty_waste in [0.1, 1]:
+            exact = partial_ot_unpaired(
+                locations_pred, locations_gt, penalty_waste=penalty_waste
+            )
+            for max_rounds in [1, 50]:
+                ot_error, error_bound = partial_ot_unpaired(
+                    locations_pred,
+                    locations_gt,
+                    penalty_waste=penalty_waste,
+                    k=3,
+                    max_rounds=max_rounds,
+                    return_error_estimate=True,
+                )
+                assert ot_error - error_bound <= exact + 1e-9 <= ot_error + 2e-9
+            assert np.isclose(ot_error, exact) and np.isclose(error_bound, 0)
+
+    def test_sparse_hub_routing(self):
+        """Test that the mass routed over the hub is transported between
+        nearby locations, close to the exact error"""
+        np.random.seed(7)
+        locations_gt = np.random.rand(400, 2)
+        locations_pred = locations_gt + np.random.normal(0, 0.02, (400, 2))
+        exact = partial_ot_unpaired(locations_pred, locations_gt, penalty_waste=1)
+        for max_hub_pairs in [10**7, 0]:
+            ot_error = partial_ot_unpaired(
+                locations_pred,
+                locations_gt,
+                penalty_waste=1,
+                k=3,
+                max_hub_pairs=max_hub_pairs,
+            )
+            assert exact - 1e-9 <= ot_error <= 1.05 * exact
@@ -1,5 +1,7 @@
 from geot.sinkhorn_loss import SinkhornLoss, sinkhorn_loss_from_numpy
 import numpy as np
+import pytest
+import torch
 
 test_cdist = np.array(
     [
@@ -31,3 +33,93 @@ class TestSinkhornLoss:
             loss_class=SinkhornLoss,
         ).item()
         assert np.isclose(loss, 0.0196294)
+
+    def test_batch_size_change_shares_cost(self):
+        """Test that the cost matrix is broadcasted, not copied, over the batch"""
+        sinkhorn = SinkhornLoss(test_cdist)
+        pred, gt = np.random.rand(8, 4), np.random.rand(8, 4)
+        full_loss = sinkhorn(torch.from_numpy(pred), torch.from_numpy(gt))
+        assert sinkhorn.cost_matrix.size()[0] == 8
+        assert (
+            sinkhorn.cost_matrix.data_ptr() == sinkhorn.cost_matrix_original.data_ptr()
+        )
+        # a smaller last batch gives the same per-sample losses
+        partial_loss = sinkhorn(torch.from_numpy(pred[:3]), torch.from_numpy(gt[:3]))
+        rest_loss = sinkhorn(torch.from_numpy(pred[3:]), torch.from_numpy(gt[3:]))
+        assert torch.isclose(full_loss, partial_loss + rest_loss)
+
+    def test_dtype_policy(self):
+        """Test that float32 computation is close to float64"""
+        pred, gt = np.random.rand(4, 4), np.random.rand(4, 4)
+        losses = {}
+        for dtype in ["float32", "float64"]:
+            sinkhorn = SinkhornLoss(test_cdist, dtype=dtype)
+            assert sinkhorn.cost_matrix_original.dtype == getattr(torch, dtype)
+            losses[dtype] = sinkhorn(torch.from_numpy(pred), torch.from_numpy(gt))
+            assert losses[dtype].dtype == getattr(torch, dtype)
+        assert np.isclose(losses["float32"].item(), losses["float64"].item(), rtol=1e-4)
+
+    def test_warm_start(self):
+        """Test that warm-started solves converge to the solution"""
+        torch.manual_seed(0)
+        pred = torch.rand(3, 4, dtype=torch.float64)
+        gt = torch.rand(3, 4, dtype=torch.float64)
+        reference = SinkhornLoss(test_cdist, warm_start=True, scaling=0.95)(pred, gt)
+        sinkhorn = SinkhornLoss(test_cdist, warm_start=True)
+        cold_loss = sinkhorn(pred, gt, sample_ids=[5, 6, 7])
+        assert set(sinkhorn.potentials.keys()) == {5, 6, 7}
+        for _ in range(5):
+            warm_loss = sinkhorn(pred, gt, sample_ids=[5, 6, 7])
+        assert abs(warm_loss - reference) < abs(cold_loss - reference)
+        assert torch.isclose(warm_loss, reference, rtol=1e-3)
+
+        # only the potentials of the most recent samples are kept
+        sinkhorn = SinkhornLoss(test_cdist, warm_start=True, max_potentials=4)
+        for sample_ids in [[0, 1, 2], [3, 1, 4], [5, 6, 7]]:
+            sinkhorn(pred, gt, sample_ids=sample_ids)
+        assert list(sinkhorn.potentials.keys()) == [4, 5, 6, 7]
+        sinkhorn.reset_potentials()
+        assert len(sinkhorn.potentials) == 0
+
+    def test_chunked(self):
+        """Test that solving in chunks gives the same loss and gradients"""
+        pred = torch.rand(5, 3, 4, dtype=torch.float64, requires_grad=True)
+        gt = torch.rand(5, 3, 4, dtype=torch.float64)
+        for backend in ["geomloss", "native"]:
+            losses, grads = [], []
+            for max_memory in [None, 4 * 16 * 8 * 2]:
+                sinkhorn = SinkhornLoss(
+                    test_cdist, backend=backend, max_memory=max_memory
+                )
+                losses.append(sinkhorn(pred, gt))
+                grads.append(torch.autograd.grad(losses[-1], pred)[0])
+            assert sinkhorn.chunk_size(15, 4, 4, 8) == 2
+            assert torch.isclose(losses[0], losses[1])
+            assert torch.allclose(grads[0], grads[1])
+
+    def test_chunked_cost_per_batch_element(self):
+        """Test that chunks use the costs of their batch elements"""
+        torch.manual_seed(1)
+        cost_matrices = torch.rand(4, 6, 6, dtype=torch.float64)
+        for shape in [(4, 6), (4, 3, 6)]:
+            pred = torch.rand(*shape, dtype=torch.float64)
+            gt = torch.rand(*shape, dtype=torch.float64)
+            losses = [
+                SinkhornLoss(
+                    cost_matrices,
+                    normalize_cost=False,
+                    backend="native",
+                    max_memory=max_memory,
+                )(pred, gt)
+                for max_memory in [None, 4 * 36 * 8 * 2]
+            ]
+            separate = sum(
+                SinkhornLoss(cost_matrices[i], normalize_cost=False, backend="native")(
+                    pred[i : i + 1], gt[i : i + 1]
+                )
+                for i in range(4)
+            )
+            assert torch.isclose(losses[0], losses[1])
+            assert torch.isclose(losses[0], separate)
+        with pytest.raises(ValueError):
+            SinkhornLoss(cost_matrices, backend="native")(pred[:2], gt[:2])
@@ -0,0 +1,95 @@
+import geomloss
+import numpy as np
+import torch
+from geot.cost import space_cost_matrix
+from geot.sinkhorn_loss import SinkhornLoss
+from geot.sinkhorn_solver import CoordinateCost, DenseCost, sinkhorn_divergence
+
+
+class TestSinkhornSolver:
+    def test_same_as_geomloss(self):
+        """Test that the block-wise solver gives the same loss and gradients as
+        geomloss on the dense cost matrix"""
+        np.random.seed(0)
+        locations = np.random.rand(30, 2) * 3000
+        cost_matrix = torch.from_numpy(space_cost_matrix(locations, speed_factor=5))
+        a = torch.rand(3, 30, dtype=torch.float64, requires_grad=True)
+        b = torch.rand(3, 30, dtype=torch.float64)
+        dummy_locs = torch.arange(30).double().view(1, -1, 1).repeat(3, 1, 1)
+        for reach in [None, 0.3]:
+            geomloss_obj = geomloss.SamplesLoss(
+                "sinkhorn",
+                cost=lambda x, y: cost_matrix.expand(3, -1, -1),
+                backend="tensorized",
+                blur=0.1,
+                reach=reach,
+                diameter=1,
+            )
+            loss_geomloss = geomloss_obj(a, dummy_locs, b, dummy_locs)
+            (grad_geomloss,) = torch.autograd.grad(loss_geomloss.sum(), a)
+
+            lazy_cost = CoordinateCost(locations, speed_factor=5, block_size=7)
+            loss = sinkhorn_divergence(
+                a, b, lazy_cost, blur=0.1, reach=reach, diameter=1
+            )
+            (grad,) = torch.autograd.grad(loss.sum(), a)
+            assert torch.allclose(loss, loss_geomloss)
+            assert torch.allclose(grad, grad_geomloss)
+
+    def test_from_coordinates(self):
+        np.random.seed(1)
+        locations = np.random.rand(40, 2) * 1000
+        sinkhorn = SinkhornLoss.from_coordinates(locations, power=2, block_size=16)
+        assert np.isclose(sinkhorn.cost_operator.max(), 1)
+        pred = torch.rand(4, 40, requires_grad=True)
+        loss = sinkhorn(pred, pred.detach())
+        loss.backward()
+        assert torch.isfinite(loss) and pred.grad.shape == (4, 40)
+        # the loss of the ground truth is lower than for a shuffled prediction
+        shuffled_loss = sinkhorn(pred.detach()[:, torch.randperm(40)], pred.detach())
+        assert loss < shuffled_loss
+
+    def test_native_backend(self):
+        """Test that the native backend equals geomloss (with the diameter that
+        geomloss derives from the dummy locations)"""
+        np.random.seed(2)
+        cost_matrix = space_cost_matrix(np.random.rand(20, 2) * 3000)
+        pred, gt = torch.rand(4, 20, dtype=torch.float64), torch.rand(4, 20)
+        for mode in ["unbalanced", "balanced"]:
+            loss_geomloss = SinkhornLoss(cost_matrix, mode=mode)(pred, gt)
+            native = SinkhornLoss(cost_matrix, mode=mode, backend="native", diameter=19)
+            assert torch.isclose(native(pred, gt), loss_geomloss)
+            assert native.iterations == 5
+
+    def test_cost_per_batch_element(self):
+        """Test that a batch of cost matrices equals separate solves"""
+        np.random.seed(3)
+        cost_matrices = torch.rand(3, 10, 10, dtype=torch.float64)
+        a = torch.rand(3, 10, dtype=torch.float64)
+        b = torch.rand(3, 10, dtype=torch.float64)
+        batch_loss = sinkhorn_divergence(
+            a, b, DenseCost(cost_matrices), reach=0.5, diameter=1
+        )
+        for i in range(3):
+            loss = sinkhorn_divergence(
+                a[i : i + 1],
+                b[i : i + 1],
+                DenseCost(cost_matrices[i]),
+                reach=0.5,
+                diameter=1,
+            )
+            assert torch.isclose(loss[0], batch_loss[i])
+
+    def test_early_stopping(self):
+        np.random.seed(4)
+        cost = DenseCost(torch.rand(15, 15, dtype=torch.float64))
+        a = torch.rand(2, 15, dtype=torch.float64)
+        b = torch.rand(2, 15, dtype=torch.float64)
+        # balanced OT needs the same mass
+        b = b / b.sum(dim=-1, keepdim=True) * a.sum(dim=-1, keepdim=True)
+        _, log = sinkhorn_divergence(
+            a, b, cost, blur=0.3, tol=1e-6, max_iter=500, log=True
+        )
+        assert log["error"] < 1e-6 and log["iterations"] < 500
+        _, log = sinkhorn_divergence(a, b, cost, tol=1e-12, max_iter=20, log=True)
+        assert log["iterations"] == 20
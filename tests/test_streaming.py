@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+from geot.cost import space_cost_matrix, sparse_space_cost_matrix
+from geot.instrumentation import instrument
+from geot.partialot import PartialOT
+from geot.plans import read_plans
+from geot.streaming import stream_ot_errors
+
+
+class TestStreaming:
+    def test_stream_ot_errors(self, tmp_path):
+        np.random.seed(0)
+        cost_matrix = space_cost_matrix(np.random.rand(5, 2))
+        timestamps = pd.date_range("2024-01-01", periods=7, freq="h")
+        # files have the stations in a different order than the cost matrix
+        station_ids = ["a", "b", "c", "d", "e"]
+        observations = pd.DataFrame(
+            np.random.rand(7, 5), columns=station_ids[::-1], index=timestamps
+        )
+        predictions = observations + np.random.rand(7, 5)
+        observations.to_csv(tmp_path / "obs.csv", index_label="timestamp")
+        predictions.to_csv(tmp_path / "pred.csv", index_label="timestamp")
+
+        results = list(
+            stream_ot_errors(
+                tmp_path / "pred.csv",
+                tmp_path / "obs.csv",
+                cost_matrix,
+                station_ids,
+                chunksize=3,
+                return_plans=True,
+                output_path=tmp_path / "errors.csv",
+                plans_path=tmp_path / "plans.bin",
+            )
+        )
+        expected = PartialOT(cost_matrix)(
+            np.ascontiguousarray(predictions[station_ids]),
+            np.ascontiguousarray(observations[station_ids]),
+        )
+        assert len(results) == 7
+        assert np.allclose([error for _, error, _ in results], expected)
+        assert results[0][2].shape == (6, 6)
+        written = pd.read_csv(tmp_path / "errors.csv")
+        assert np.allclose(written["ot_error"], expected)
+        # archived plans are the same as the yielded plans
+        archived = list(read_plans(tmp_path / "plans.bin"))
+        assert len(archived) == 7
+        assert np.allclose(archived[4].toarray(), results[4][2].toarray())
+
+    def test_mismatch_and_early_exit(self, tmp_path):
+        np.random.seed(1)
+        cost_matrix = space_cost_matrix(np.random.rand(4, 2))
+        station_ids = ["a", "b", "c", "d"]
+        timestamps = pd.date_range("2024-01-01", periods=8, freq="h")
+        observations = pd.DataFrame(
+            np.random.rand(8, 4), columns=station_ids, index=timestamps
+        )
+        observations.to_csv(tmp_path / "obs.csv", index_label="timestamp")
+        # the predictions are missing the last chunk
+        observations[:4].to_csv(tmp_path / "pred.csv", index_label="timestamp")
+        stream = stream_ot_errors(
+            tmp_path / "pred.csv",
+            tmp_path / "obs.csv",
+            cost_matrix,
+            station_ids,
+            chunksize=4,
+        )
+        with pytest.raises(ValueError):
+            list(stream)
+        # the plans of the first chunk are written when the caller stops early
+        stream = stream_ot_errors(
+            tmp_path / "obs.csv",
+            tmp_path / "obs.csv",
+            cost_matrix,
+            station_ids,
+            chunksize=4,
+            plans_path=tmp_path / "plans.bin",
+        )
+        next(stream)
+        stream.close()
+        assert len(list(read_plans(tmp_path / "plans.bin"))) == 4
+
+    def test_sparse_cost_solved_once(self, tmp_path):
+        """Test that the errors of a sparse cost are taken from the plans"""
+        np.random.seed(2)
+        locations = np.random.rand(6, 2)
+        cost_matrix = sparse_space_cost_matrix(locations, k=2)
+        station_ids = ["a", "b", "c", "d", "e", "f"]
+        observations = pd.DataFrame(np.random.rand(5, 6), columns=station_ids)
+        predictions = pd.DataFrame(np.random.rand(5, 6), columns=station_ids)
+        observations.to_csv(tmp_path / "obs.csv", index_label="timestamp")
+        predictions.to_csv(tmp_path / "pred.csv", index_label="timestamp")
+        with instrument() as instrumentation:
+            results = list(
+                stream_ot_errors(
+                    tmp_path / "pred.csv",
+                    tmp_path / "obs.csv",
+                    cost_matrix,
+                    station_ids,
+                    return_plans=True,
+                )
+            )
+        assert instrumentation.counters["partialot.exact_solves"] == 5
+        expected = PartialOT(cost_matrix)(predictions.values, observations.values)
+        assert np.allclose([error for _, error, _ in results], expected)
@@ -0,0 +1,32 @@
+import numpy as np
+from geot.cost import space_cost_matrix
+from geot.treeot import TreeOT, compare_to_exact
+
+
+class TestTreeOT:
+    def test_upper_bound(self):
+        """Test that the tree distance bounds and correlates with exact OT"""
+        np.random.seed(4)
+        coords = np.random.rand(60, 2) * 5000
+        cost_matrix = space_cost_matrix(coords, speed_factor=20)
+        tree_ot = TreeOT(coords, speed_factor=20, penalty_waste=cost_matrix.max())
+        y_true = np.random.poisson(3, (20, 60)).astype(float)
+        noise = np.random.rand(20, 1) * 4
+        y_pred = np.clip(y_true + np.random.normal(size=(20, 60)) * noise, 0, None)
+        comparison = compare_to_exact(tree_ot, cost_matrix, y_pred, y_true)
+        assert comparison["upper_bound"]
+        assert comparison["spearman"] > 0.9
+        # batch and single sample
+        errors = tree_ot(y_pred, y_true)
+        assert errors.shape == (20,)
+        assert np.isclose(tree_ot(y_pred[0], y_true[0]), errors[0])
+
+    def test_waste(self):
+        """Test the cost of mass that is only imported or exported"""
+        coords = np.array([[0, 0], [0, 0], [1, 1]])
+        tree_ot = TreeOT(coords, penalty_waste=5, max_depth=3)
+        # locations with the same coordinates
+        assert tree_ot([1, 0, 0], [0, 1, 0]) == 0
+        # distance from the location to the root plus the penalty
+        assert tree_ot([0, 0, 2], [0, 0, 0]) > 2 * 5
+        assert tree_ot([0, 0, 0], [0, 0, 2]) == tree_ot([0, 0, 2], [0, 0, 0])